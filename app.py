@@ -1,40 +1,95 @@
+import os
+import signal
+
 from flask import Flask, json
 
 if __name__ == '__main__':
     # noinspection PyUnresolvedReferences
     import monkey_patch
-from config import config
-from extensions import oauth, cache, login_manager, cors, init_db
-from socket_server import sio
-from utils import configure_global_logging, PydanticEncoder
+from assets import assets
+from config import config, parse_bool
+from extensions import oauth, cache, login_manager, cors, init_db, redis_store
+from fanout import coalescer, directory_feed, presence_diffs
+from history import chat_history
+from memberships import migrate_listeners
+from metrics import metrics
+from models import Stream, User
+from presence import presence
+from ratelimit import rate_limiter
+from registry import registry
+from search import ensure_search_fields
+from sessions import user_sessions
+from socket_server import sio, sweep_absent
+from spotify import spotify
+from tokens import token_manager
+from tracks import track_cache
+from utils import configure_global_logging, shutdown_logging, PydanticEncoder
+from wire import wire, FanoutRedisManager, MsgPackRedisManager
+from workers import worker
+from writebehind import chat_writer
 
-configure_global_logging()
+configure_global_logging(config)
 
 
 def init_app(_app):
     app.json_encoder = PydanticEncoder
     oauth.init_app(_app, cache=cache)
+    spotify.init_app(_app, sio)
+    queue_url = f"redis://{_app.config['CACHE_REDIS_HOST']}"
+    manager = MsgPackRedisManager if _app.config.get("SOCKETIO_QUEUE_FORMAT", "pickle") == "msgpack" \
+        else FanoutRedisManager
+    # same channel Flask-SocketIO uses, so workers on the default manager can still be read during a deploy.
+    queue = manager(queue_url, channel="flask-socketio", chunk_size=int(_app.config.get("ROOM_FANOUT_CHUNK", 500)),
+                    is_packed=wire.is_packed)
     sio.init_app(
         _app,
-        message_queue=f"redis://{_app.config['CACHE_REDIS_HOST']}",
+        client_manager=queue,
         cors_allowed_origins="*",
         logger=_app.config["DEBUG"],
         engineio_logger=_app.config["DEBUG"],
         json=json
     )
+    worker.init_app(_app, sio)
+    wire.init_app(_app, sio)
     cache.init_app(_app)
+    redis_store.init_app(_app)
+    rate_limiter.init_app(_app)
+    chat_history.init_app(_app)
     login_manager.init_app(_app)
     init_db(_app)
+    if worker.primary:
+        ensure_search_fields(Stream, User)
+        migrate_listeners()
     cors.init_app(_app)
+    registry.init_app(_app, sio)
+    user_sessions.init_app(_app, sio)
+    presence.init_app(_app, sio)
+    if worker.primary:
+        sio.start_background_task(sweep_absent, _app)
+    coalescer.init_app(_app, sio)
+    directory_feed.init_app(_app, sio)
+    presence_diffs.init_app(_app, sio)
+    chat_writer.init_app(_app, sio)
+    track_cache.init_app(_app, sio)
+    token_manager.init_app(_app, sio)
+    metrics.init_app(_app, sio)
+    assets.init_app(_app)
 
 
 def register_blueprints(_app):
     from blueprints.api import blueprint as api_blueprint
     _app.register_blueprint(api_blueprint)
 
+    from blueprints.metrics import blueprint as metrics_blueprint
+    _app.register_blueprint(metrics_blueprint)
+
     from blueprints.views import blueprint as views_blueprint
     _app.register_blueprint(views_blueprint)
 
+    if str(_app.config.get("ENV")).lower() == "loadtest" and parse_bool(_app.config.get("LOADTEST_AUTH")):
+        from blueprints.loadtest import blueprint as loadtest_blueprint
+        _app.register_blueprint(loadtest_blueprint)
+
 
 print("Creating app.")
 app = Flask(__name__, static_folder="static/", template_folder="templates/")
@@ -44,6 +99,24 @@ print("init extensions and register blueprints")
 init_app(app)
 register_blueprints(app)
 
+
+def shutdown():
+    """Writes what is still buffered and ends the process, the background tasks never return on their own."""
+    try:
+        chat_writer.flush()
+        metrics.shutdown()
+    except Exception as e:
+        app.logger.exception(e)
+    shutdown_logging()
+    os._exit(0)
+
+
 if __name__ == '__main__':
+    import eventlet
+
+    # on docker stop. the handler runs on the hub, the flushes do IO so they get their own green thread.
+    signal.signal(signal.SIGTERM, lambda *_: eventlet.spawn(shutdown))
     print(f"starting at: {app.config['APP_HOST']}:{app.config['APP_PORT']}")
-    sio.run(app, host=app.config["APP_HOST"], port=app.config['APP_PORT'])
+    sio.run(app, host=app.config["APP_HOST"], port=int(app.config['APP_PORT']))
+    # ctrl-c
+    shutdown()
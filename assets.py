@@ -0,0 +1,135 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+
+from flask import Response, request, send_file
+from werkzeug.exceptions import NotFound
+
+from config import parse_bool
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# the content hash the vue cli build puts in the names of everything but index.html.
+HASHED_NAME = r"[.-][0-9a-f]{8,}\.\w+$"
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml",
+                "application/manifest+json", "font/ttf", "application/wasm")
+
+
+class Asset(object):
+    __slots__ = ("path", "full_path", "mimetype", "etag", "cache_control", "body", "variants")
+
+    def __init__(self, path, full_path, mimetype, etag, cache_control, body=None):
+        self.path = path
+        self.full_path = full_path
+        self.mimetype = mimetype
+        self.etag = etag
+        self.cache_control = cache_control
+        # None for files too big to keep, they're sent from disk
+        self.body = body
+        # encoding -> (etag, body), only the ones smaller than the file itself
+        self.variants = {}
+
+
+class AssetIndex(object):
+    """
+    The SPA in templates/dist, indexed once at startup.
+
+    Files up to ASSETS_MAX_MEMORY_SIZE are kept in memory with their gzip, and brotli if it's
+    installed, variants. Hashed assets are cached for good, everything else is revalidated with its
+    strong ETag. Paths that aren't in the index get index.html.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("Assets")
+        self.enabled = True
+        self.root = None
+        self.max_memory_size = 1024 * 1024
+        self.min_compress_size = 1024
+        self.hashed_name = re.compile(HASHED_NAME)
+        # path relative to the root -> Asset
+        self._assets = {}
+
+    def init_app(self, app):
+        self.enabled = parse_bool(app.config.get("ASSETS_IN_MEMORY", self.enabled))
+        self.root = os.path.join(app.root_path, "templates", "dist")
+        self.max_memory_size = int(app.config.get("ASSETS_MAX_MEMORY_SIZE", self.max_memory_size))
+        self.min_compress_size = int(app.config.get("ASSETS_MIN_COMPRESS_SIZE", self.min_compress_size))
+        self.hashed_name = re.compile(app.config.get("ASSETS_HASHED_NAME", HASHED_NAME))
+        if self.enabled:
+            self.index()
+
+    def index(self):
+        assets = {}
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                full_path = os.path.join(directory, name)
+                path = os.path.relpath(full_path, self.root).replace(os.sep, "/")
+                assets[path] = self._load(path, full_path)
+        self._assets = assets
+        in_memory = sum(len(asset.body) for asset in assets.values() if asset.body is not None)
+        self.logger.info("Indexed %s assets, %s bytes in memory.", len(assets), in_memory)
+
+    def _load(self, path, full_path):
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        cache_control = IMMUTABLE if self.hashed_name.search(path) else REVALIDATE
+        digest = hashlib.sha1()
+        with open(full_path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                digest.update(chunk)
+        etag = digest.hexdigest()[:20]
+        if os.path.getsize(full_path) > self.max_memory_size:
+            return Asset(path, full_path, mimetype, etag, cache_control)
+
+        with open(full_path, "rb") as f:
+            body = f.read()
+        asset = Asset(path, full_path, mimetype, etag, cache_control, body)
+        if len(body) >= self.min_compress_size and mimetype.startswith(COMPRESSIBLE):
+            compressed = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                compressed["br"] = brotli.compress(body)
+            for encoding, variant in compressed.items():
+                if len(variant) < len(body):
+                    asset.variants[encoding] = (f"{etag}-{encoding}", variant)
+        return asset
+
+    def response(self, path):
+        asset = self._assets.get(path) if path else None
+        if asset is None:
+            asset = self._assets.get("index.html")
+            if asset is None:
+                raise NotFound()
+
+        if asset.body is None:
+            response = send_file(asset.full_path, mimetype=asset.mimetype, etag=asset.etag, conditional=True)
+            response.headers["Cache-Control"] = asset.cache_control
+            return response
+
+        etag, body, encoding = asset.etag, asset.body, None
+        for candidate in ("br", "gzip"):
+            if candidate in asset.variants and candidate in request.accept_encodings:
+                encoding = candidate
+                etag, body = asset.variants[candidate]
+                break
+
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype=asset.mimetype)
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = asset.cache_control
+        if asset.variants:
+            response.vary.add("Accept-Encoding")
+        return response
+
+
+assets = AssetIndex()
@@ -1,36 +1,43 @@
-import re
-
 from bson import ObjectId
+from bson.errors import InvalidId
 from flask import Blueprint, jsonify, url_for, current_app, request, render_template_string
 from flask_login import current_user, login_user, login_required, logout_user
 from mongoengine import DoesNotExist
 from werkzeug.utils import redirect
 
+import directory
+import memberships
+import search
 from extensions import oauth
-from models import User, Token, Stream
+from history import chat_history
+from metrics import metrics
+from sessions import user_sessions
+from spotify import spotify
+from tokens import token_manager
+from models import User, Token
 from utils import prepare_status, message, done_page
 
 blueprint = Blueprint("api", __name__, url_prefix="/api")
+metrics.instrument_blueprint(blueprint)
 
 
 @blueprint.route('/access_token')
 @login_required
 def access_token():
-    _me = oauth.spotify.get("me")
-    return jsonify({"access_token": current_user.token.access_token})
+    return jsonify({"access_token": token_manager.get(current_user.id)["access_token"]})
 
 
 @blueprint.route('/test')
 @login_required
 def test():
-    resp = oauth.spotify.get("me").json()
+    resp = spotify.get("me").json()
     return jsonify(resp)
 
 
 @blueprint.route('/auth')
 def auth():
     token = oauth.spotify.authorize_access_token()
-    resp = oauth.spotify.get("me")
+    resp = spotify.get("me", token=token)
     user_me = resp.json()
     try:
         user = User.objects.get(username=user_me["id"])
@@ -45,6 +52,9 @@ def auth():
 
     user.token.set_from_dict(token)
     user.save()
+    user_sessions.invalidate(user.id)
+    token_manager.store(user.id, user.token.to_token())
+    memberships.update_user(user)
     login_user(user, remember=True)
     return redirect(url_for('api.done'))
 
@@ -58,6 +68,7 @@ def login():
 @blueprint.route('/logout')
 @login_required
 def logout():
+    token_manager.forget(current_user.id)
     logout_user()
     return redirect(url_for('api.done'))
 
@@ -83,35 +94,31 @@ def stream_list():
     max_page_size = current_app.config.get("MAX_PAGE_SIZE", 20)
     order_by = request.args.get("order_by", default=None)
     active = str(request.args.get("active", default="true")).lower() in ["true", "yes", "1"]
+    cursor = request.args.get("cursor", default=None)
     try:
-        from_ = int(request.args.get("from", default=0))
-        amount = int(request.args.get("amount", default=max_page_size))
+        from_ = max(0, int(request.args.get("from", default=0)))
+        amount = max(1, min(int(request.args.get("amount", default=max_page_size)), max_page_size))
     except ValueError:
-        return
+        return {
+            "message": message("Invalid page", "ERROR"),
+        }
 
     filter_ = request.args.get("filter", default=None)
 
-    result = stream_list_query(from_, amount, filter_, order_by, active)
-    stream_count = result["stream_count"]
-    streams = result["streams"]
-    user_default_img = url_for(
-        'static', filename="user_default.png",
-        _external=True, _scheme=current_app.config.get("EXTERNAL_SCHEME", "http")
-    )
+    try:
+        result = directory.stream_page(amount, order_by, active, filter_, cursor=cursor, from_=from_)
+    except ValueError:
+        return {
+            "message": message("Invalid cursor", "ERROR"),
+        }
+    user_default_img = directory.user_default_img()
     return {
         "streams": [
-            {
-                "name": stream["name"], "listeners_length": stream["listeners_length"],
-                "utcdate": stream["date"],
-                "streamer": {
-                    "name": stream["streamer"][0].get("display_name", stream["streamer"][0]["username"]),
-                    "img": stream["streamer"][0].get("img", user_default_img)
-                },
-                "order_index": from_ + index,
-                "pk": stream["_id"].__str__()
-            } for index, stream in enumerate(streams)
+            {**directory.stream_entry(stream, user_default_img), "order_index": result["from"] + index}
+            for index, stream in enumerate(result["streams"])
         ],
-        "stream_count": stream_count
+        "stream_count": directory.stream_count(active, filter_),
+        "next_cursor": result["next_cursor"]
     }
 
 
@@ -121,117 +128,75 @@ def listener_list():
     max_page_size = current_app.config.get("MAX_PAGE_SIZE", 20)
     stream_id = request.args.get("stream", default=None)
 
-    if stream_id is None and current_user.stream:
-        stream_id = current_user.stream.pk
+    if stream_id is None and current_user.stream_id:
+        stream_id = current_user.stream_id
     elif stream_id is None:
         return {
             "message": message("No stream is specified", "ERROR"),
         }
+    if not ObjectId.is_valid(stream_id):
+        return {
+            "message": message("Invalid stream", "ERROR"),
+        }, 400
+    cursor = request.args.get("cursor", default=None)
     try:
-        from_ = int(request.args.get("from", default=0))
-        amount = int(request.args.get("amount", default=max_page_size))
+        from_ = max(0, int(request.args.get("from", default=0)))
+        amount = max(1, min(int(request.args.get("amount", default=max_page_size)), max_page_size))
     except ValueError:
-        return
+        return {
+            "message": message("Invalid page", "ERROR"),
+        }
 
-    filter_ = re.escape(request.args.get("filter", default=""))
+    filter_ = request.args.get("filter", default="")
 
     user_default_img = url_for(
         'static', filename="user_default.png"
     )
-    result = listener_query(stream_id, filter_, from_, amount)
+    try:
+        result = listener_query(stream_id, filter_, from_, amount, cursor)
+    except ValueError:
+        return {
+            "message": message("Invalid cursor", "ERROR"),
+        }
     return {
         "listeners": [
-            {
-                "name": listener.get("display_name", listener.get("_id")),
-                "img": listener.get("img", user_default_img),
-                "order_index": from_ + index,
-                "pk": listener["_id"].__str__()
-            } for index, listener in enumerate(result["listeners"])
+            {**memberships.listener_summary(listener["user"], listener.get("display_name"), listener.get("img"),
+                                            user_default_img),
+             "order_index": result["from"] + index}
+            for index, listener in enumerate(result["listeners"])
         ],
-        "listener_count": result["listener_count"]
+        "listener_count": result["listener_count"],
+        "next_cursor": result["next_cursor"]
     }
 
 
-def stream_list_query(from_, amount, filter_=None, order_by=None, active=None):
-    filter_ = filter_ or ""
-    order_by = order_by or {"listeners_length": -1}
-    active = active if active is not None else True
-
-    pipeline = [
-        {"$match": {"$expr": {"$and": [
-            {"$regexMatch": {"input": "$name", "regex": f".*{filter_}.*", "options": "i"}},
-            {"$eq": ["$active", active]}
-        ]}}},
-        {"$lookup": {"from": "user", "localField": "streamer", "foreignField": "_id", "as": "streamer"}},
-        {"$project": {
-            "listeners_length": {"$size": "$listeners"},
-            "date": 1,
-            "name": 1,
-            "active": 1,
-            "streamer": 1,
-        }},
-        {"$sort": {"date": -1, "+name": 1, **order_by}},
-        {"$group": {"_id": None, "stream_count": {"$sum": 1}, "streams": {"$push": "$$ROOT"}}},
-        {"$project": {
-            "stream_count": 1,
-            "streams": {"$slice": ["$streams", from_, amount]}
-        }}
-    ]
-    try:
-        return Stream.objects().no_cache().aggregate(pipeline).next()
-    except StopIteration:
-        return {"stream_count": 0, "streams": []}
-
-
-def listener_query(stream_id, filter_, from_, amount):
-    pipeline = [
-        {"$match": {"_id": ObjectId(stream_id)}},
-        {"$lookup":
-            {
-                "from": "user",
-                "let": {"listeners": "$listeners"},
-                "pipeline": [
-                    {
-                        "$match":
-                            {
-                                "$expr":
-                                    {
-                                        "$and":
-                                            [
-                                                {"$in": ["$_id", "$$listeners"]},
-                                                {"$or": [
-                                                    {
-                                                        "$regexMatch":
-                                                            {"input": "$display_name", "regex": f".*{filter_}.*",
-                                                             "options": "i"}
-                                                    },
-                                                    {
-                                                        "$regexMatch":
-                                                            {"input": "$display_name", "regex": f".*{filter_}.*",
-                                                             "options": "i"}
-                                                    }
-                                                ]}
-                                            ]
-                                    }
-                            }
-                    }
-                ],
-                "as": "listeners"
-            }},
-        {"$project": {
-            "listener_count": {"$size": "$listeners"},
-            "listeners": {"$slice": [
-                "$listeners",
-                from_,
-                amount
-            ]},
-            "_id": 0
-        }},
-    ]
+@blueprint.route('/chat-history')
+@login_required
+def chat_history_list():
+    max_page_size = current_app.config.get("MAX_PAGE_SIZE", 20)
+    stream_id = request.args.get("stream", default=None)
+
+    if stream_id is None and current_user.stream_id:
+        stream_id = current_user.stream_id
+    elif stream_id is None:
+        return {
+            "message": message("No stream is specified", "ERROR"),
+        }
     try:
-        return Stream.objects().no_cache().aggregate(pipeline).next()
-    except StopIteration:
+        amount = max(1, min(int(request.args.get("amount", default=max_page_size)), max_page_size))
+        return chat_history.page(stream_id, amount, before=request.args.get("before", default=None))
+    except InvalidId:
         return {
-            "listener_count": 0,
-            "listeners": []
+            "message": message("Invalid stream", "ERROR"),
+        }, 400
+    except ValueError:
+        return {
+            "message": message("Invalid page", "ERROR"),
         }
+
+
+def listener_query(stream_id, filter_, from_, amount, cursor=None):
+    if search.normalize(filter_):
+        return search.cached("listener_query", (str(stream_id), search.normalize(filter_), from_, amount, cursor),
+                             lambda: memberships.listener_page(stream_id, amount, filter_, cursor, from_))
+    return memberships.listener_page(stream_id, amount, filter_, cursor, from_)
@@ -0,0 +1,33 @@
+from flask import Blueprint, jsonify, request
+from flask_login import login_user
+from mongoengine import DoesNotExist
+
+from metrics import metrics
+from models import User, Token
+from utils import message
+
+# spotify ids are alphanumeric, so nobody who logged in with spotify has a username like this.
+USERNAME_PREFIX = "loadtest:"
+
+blueprint = Blueprint("loadtest", __name__, url_prefix="/api/loadtest")
+metrics.instrument_blueprint(blueprint)
+
+
+@blueprint.route('/login', methods=["POST"])
+def login():
+    """Logs in as a load test user without spotify, only registered by the LoadTestConfig."""
+    username = request.args.get("username", "")
+    if not username:
+        return jsonify({"message": message("Username is required", "ERROR")}), 400
+    username = USERNAME_PREFIX + username
+    try:
+        user = User.objects.get(username=username)
+    except DoesNotExist:
+        user = User()
+        user.username = username
+        user.display_name = username
+        # never expires, the load test doesn't talk to spotify.
+        user.token = Token(access_token="loadtest", refresh_token="loadtest", expires_at=2 ** 31 - 1)
+        user.save()
+    login_user(user)
+    return jsonify({"id": user.get_id()})
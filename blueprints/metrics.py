@@ -0,0 +1,19 @@
+import hmac
+
+from flask import Blueprint, Response, current_app, request, abort
+
+from metrics import metrics
+
+blueprint = Blueprint("metrics", __name__)
+
+
+@blueprint.route('/metrics')
+def metrics_text():
+    token = current_app.config.get("METRICS_TOKEN")
+    if not token:
+        # open only in development, anywhere else it's off until a token is set.
+        if current_app.config.get("ENV") != "development":
+            abort(404)
+    elif not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        abort(401)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
@@ -1,35 +1,142 @@
 import os
 
+TRUE = ("1", "true", "yes", "on")
+FALSE = ("0", "false", "no", "off", "")
+
+
+def parse_bool(value):
+    """A boolean setting, strictly. The environment only has strings and "False" is truthy."""
+    if isinstance(value, bool) or value is None:
+        return bool(value)
+    text = str(value).strip().lower()
+    if text in TRUE:
+        return True
+    if text in FALSE:
+        return False
+    raise ValueError(f"Not a boolean: {value!r}.")
+
 
 class Config(object):
     def __init__(self):
         for k in self.__dir__():
             if not k.startswith("_") and k.isupper() and k in os.environ:
-                setattr(self, k, os.getenv(k))
+                value = os.getenv(k)
+                # the settings that are booleans here stay booleans.
+                setattr(self, k, parse_bool(value) if isinstance(getattr(self, k), bool) else value)
 
     APP_HOST = "127.0.0.1"
     APP_PORT = 5000
+    # workers started by workers.py, 0 for one per core. each one listens on APP_PORT + its WORKER_ID
+    WORKERS = 0
+    WORKER_ID = None
     SECRET_KEY = b'secret'
     SESSION_COOKIE_SAMESITE = "None"
     SESSION_COOKIE_SECURE = False
 
     SPOTIFY_CLIENT_ID = ''
     SPOTIFY_CLIENT_SECRET = ''
+    SPOTIFY_POOL_SIZE = 20
+    SPOTIFY_MAX_CONCURRENCY = 20
+    SPOTIFY_TIMEOUT = 10
+    SPOTIFY_MAX_RETRIES = 2
+    # seconds to wait for more track lookups before sending a batch
+    SPOTIFY_BATCH_WINDOW = 0.02
 
     MONGODB_DB = 'listenParty'
     MONGODB_HOST = "127.0.0.1"
     # MONGODB_USERNAME = "listenParty-mongo"
     # MONGODB_PASSWORD = "listenParty-mongo-password"
+    # pool and read preference per mongoengine alias, on top of the MONGODB_* settings. "directory" has the
+    # stream and listener lists, read from a secondary at most max_staleness_seconds (90 at least) behind.
+    MONGO_WORKLOADS = {
+        "default": {"maxPoolSize": 50, "minPoolSize": 5, "waitQueueTimeoutMS": 2000,
+                    "serverSelectionTimeoutMS": 5000, "socketTimeoutMS": 5000},
+        "directory": {"read_preference": "secondaryPreferred", "max_staleness_seconds": 90, "maxPoolSize": 20,
+                      "waitQueueTimeoutMS": 1000, "serverSelectionTimeoutMS": 5000, "socketTimeoutMS": 10000},
+    }
 
     CACHE_TYPE = "redis"
     CACHE_KEY_PREFIX = "listenParty_"
     CACHE_REDIS_HOST = "127.0.0.1"
 
+    LOG_FILE = ".logs/listenParty.log"
+    LOG_LEVEL = "DEBUG"
+    # share of the mongo commands that are logged at DEBUG, all of them are counted in the histograms
+    MONGO_LOG_SAMPLE_RATE = 0.01
+    # seconds between pushes of a worker's metrics to redis, /metrics adds up all the workers
+    METRICS_PUSH_INTERVAL = 10
+    # /metrics wants "Authorization: Bearer <token>", without one it's only served in development
+    METRICS_TOKEN = None
+    # registers /api/loadtest/login for users prefixed with "loadtest:", only with FLASK_ENV=loadtest
+    LOADTEST_AUTH = False
+
     CORS_SUPPORTS_CREDENTIALS = True
     CORS_ALLOW_ORIGIN = "*"
     EXTERNAL_SCHEME = "http"
 
     MAX_PAGE_SIZE = 50
+    STREAM_COUNT_CACHE_TIMEOUT = 5
+    SEARCH_CACHE_TIMEOUT = 3
+    # seconds between two listener_update broadcasts of a stream
+    STREAM_UPDATE_TICK = 0.2
+    # token buckets of the socket events, (tokens per second, burst) per user and per stream
+    RATE_LIMIT_ENABLED = True
+    RATE_LIMITS = {
+        "text_message": {"user": (1, 5), "stream": (20, 60)},
+        "queue_add": {"user": (0.2, 3), "stream": (1, 10)},
+        "streamer_update": {"user": (10, 20)},
+    }
+    # seconds the joins and leaves of a stream are collected for one presence_diff
+    PRESENCE_DIFF_TICK = 0.3
+    # seconds between two directory_update diffs of a worker, to the clients that sent directory_subscribe
+    DIRECTORY_FEED_TICK = 1.0
+    # streams in the directory snapshot, cached for DIRECTORY_SNAPSHOT_TIMEOUT seconds
+    DIRECTORY_FEED_SIZE = 50
+    DIRECTORY_SNAPSHOT_TIMEOUT = 5
+    # diffs kept in redis for the subscribers that get a cached snapshot
+    DIRECTORY_BACKLOG = 100
+    # a stream's room is split in shard rooms, doubling them until each has fewer listeners than this
+    ROOM_SHARD_SIZE = 1000
+    ROOM_MAX_SHARDS = 64
+    # clients a worker sends a room emit to before letting the other greenlets run
+    ROOM_FANOUT_CHUNK = 500
+
+    CHAT_WRITE_BATCH_SIZE = 100
+    CHAT_WRITE_INTERVAL = 1.0
+    CHAT_WRITE_MAX_PENDING = 10000
+
+    CHAT_HISTORY_SIZE = 50
+    CHAT_HISTORY_TTL = 24 * 60 * 60
+
+    TRACK_CACHE_LOCAL_SIZE = 1024
+    TRACK_CACHE_TIMEOUT = 24 * 60 * 60
+    TRACK_CACHE_NEGATIVE_TIMEOUT = 5 * 60
+
+    # tokens expiring in less than this many seconds are refreshed
+    TOKEN_REFRESH_MARGIN = 5 * 60
+    TOKEN_REFRESH_INTERVAL = 30
+    TOKEN_CACHE_TIMEOUT = 24 * 60 * 60
+
+    # logged in users, per worker and in redis
+    USER_SESSION_CACHE_SIZE = 4096
+    USER_SESSION_CACHE_TIMEOUT = 60 * 60
+    # seconds a disconnected user has to come back before it stops streaming or listening
+    PRESENCE_GRACE_PERIOD = 5
+    # seconds between the primary worker's sweeps for users that are gone but still listening or streaming
+    PRESENCE_SWEEP_INTERVAL = 60
+
+    # clients connecting with ?format=msgpack get the hot events as msgpack
+    WIRE_MSGPACK = True
+    # "pickle" or "msgpack", only switch once every worker can read msgpack
+    SOCKETIO_QUEUE_FORMAT = "pickle"
+
+    # templates/dist is indexed once at startup and served from memory, False while it's being rebuilt
+    ASSETS_IN_MEMORY = True
+    # bigger files are sent from disk, uncompressed
+    ASSETS_MAX_MEMORY_SIZE = 1024 * 1024
+    ASSETS_MIN_COMPRESS_SIZE = 1024
+    # names matching it are cached by the browsers for good
+    ASSETS_HASHED_NAME = r"[.-][0-9a-f]{8,}\.\w+$"
 
 
 class ProductionConfig(Config):
@@ -43,10 +150,25 @@ class ProductionConfig(Config):
     SESSION_COOKIE_SAMESITE = "None"
     SESSION_COOKIE_SECURE = True
 
+    LOG_LEVEL = "INFO"
+    MONGO_LOG_SAMPLE_RATE = 0.0
+
+
+class LoadTestConfig(Config):
+    MONGODB_DB = 'listenParty_loadtest'
+    LOADTEST_AUTH = True
+
+    LOG_LEVEL = "INFO"
+    MONGO_LOG_SAMPLE_RATE = 0.0
+    # the load tests measure the fan-out, not the limits
+    RATE_LIMIT_ENABLED = False
+
 
 flask_env = os.getenv("FLASK_ENV", default="production")
 
 if flask_env.lower() == "production":
     config = ProductionConfig()
+elif flask_env.lower() == "loadtest":
+    config = LoadTestConfig()
 else:
     config = Config()
@@ -0,0 +1,163 @@
+import base64
+import json
+from datetime import datetime, timedelta
+
+from bson import ObjectId, SON
+from flask import current_app, url_for
+from mongoengine import DEFAULT_CONNECTION_NAME
+
+import search
+from extensions import DIRECTORY_DB, cache
+from models import Stream
+
+EPOCH = datetime(1970, 1, 1)
+
+# every ordering ends with _id so the keyset is unique, and is backed by one of the Stream indexes.
+ORDERINGS = {
+    "listeners": (("listeners_count", -1), ("date", -1), ("_id", -1)),
+    "date": (("date", -1), ("_id", -1)),
+}
+DEFAULT_ORDERING = "listeners"
+
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return {"d": (value.replace(tzinfo=None) - EPOCH) // timedelta(milliseconds=1)}
+    if isinstance(value, ObjectId):
+        return {"o": str(value)}
+    return value
+
+
+def _load_value(value):
+    if isinstance(value, dict):
+        if "d" in value:
+            return EPOCH + timedelta(milliseconds=int(value["d"]))
+        if "o" in value:
+            return ObjectId(value["o"])
+        raise ValueError("Unknown cursor value.")
+    return value
+
+
+def encode_cursor(order_by, doc, index, orderings=ORDERINGS):
+    payload = {
+        "o": order_by,
+        "v": [_dump_value(doc[field]) for field, _ in orderings[order_by]],
+        "i": index
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode()
+
+
+def decode_cursor(cursor, orderings=ORDERINGS):
+    """Returns ``(order_by, values, index)``, raises ``ValueError`` for anything that isn't a cursor we made."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        order_by = payload["o"]
+        values = [_load_value(value) for value in payload["v"]]
+        index = int(payload["i"])
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Invalid cursor.")
+    if order_by not in orderings or len(values) != len(orderings[order_by]):
+        raise ValueError("Invalid cursor.")
+    return order_by, values, index
+
+
+def keyset_match(order_by, values, orderings=ORDERINGS):
+    """Match everything that comes after ``values`` in the given ordering."""
+    ordering = orderings[order_by]
+    branches = []
+    for i, (field, direction) in enumerate(ordering):
+        branch = {f: v for (f, _), v in zip(ordering[:i], values[:i])}
+        branch[field] = {"$lt" if direction < 0 else "$gt": values[i]}
+        branches.append(branch)
+    return {"$or": branches}
+
+
+def stream_match(active=True, filter_=None):
+    return {"active": active, **search.match(filter_)}
+
+
+def stream_page(amount, order_by=None, active=True, filter_=None, cursor=None, from_=0):
+    """
+    One page of the stream directory.
+
+    With a ``cursor`` the page starts right after the last stream of the previous page, otherwise
+    ``from_`` streams are skipped. Returns the streams with their streamer, the index of the first
+    one and the cursor for the next page.
+    """
+    if search.normalize(filter_):
+        return search.cached("stream_page", (amount, order_by, active, search.normalize(filter_), cursor, from_),
+                             lambda: _stream_page(amount, order_by, active, filter_, cursor, from_))
+    return _stream_page(amount, order_by, active, filter_, cursor, from_)
+
+
+def _stream_page(amount, order_by, active, filter_, cursor, from_, db_alias=DIRECTORY_DB):
+    if cursor:
+        order_by, values, from_ = decode_cursor(cursor)
+        match = {"$and": [stream_match(active, filter_), keyset_match(order_by, values)]}
+    else:
+        order_by = order_by if order_by in ORDERINGS else DEFAULT_ORDERING
+        match = stream_match(active, filter_)
+
+    pipeline = [
+        {"$match": match},
+        {"$sort": SON(ORDERINGS[order_by])},
+    ]
+    if not cursor and from_:
+        pipeline.append({"$skip": from_})
+    pipeline += [
+        {"$limit": amount},
+        {"$lookup": {"from": "user", "localField": "streamer", "foreignField": "_id", "as": "streamer"}},
+        {"$project": {
+            "listeners_count": 1,
+            "date": 1,
+            "name": 1,
+            "active": 1,
+            "streamer.username": 1,
+            "streamer.display_name": 1,
+            "streamer.img": 1,
+        }},
+    ]
+    streams = list(Stream.objects().using(db_alias).no_cache().aggregate(pipeline))
+
+    next_cursor = None
+    if streams and len(streams) == amount:
+        next_cursor = encode_cursor(order_by, streams[-1], from_ + len(streams))
+    return {"streams": streams, "from": from_, "next_cursor": next_cursor}
+
+
+def stream_count(active=True, filter_=None):
+    """Total for the directory, cached for a few seconds since every page request asks for it."""
+    key = f"stream_count::{int(active)}::{search.normalize(filter_)}"
+    count = cache.get(key)
+    if count is None:
+        count = Stream.objects(__raw__=stream_match(active, filter_)).using(DIRECTORY_DB).count()
+        cache.set(key, count, timeout=current_app.config.get("STREAM_COUNT_CACHE_TIMEOUT", 5))
+    return count
+
+
+def top_streams(amount):
+    """
+    The busiest active streams, from the primary.
+
+    The live directory's diffs go on from these, a secondary could be behind them.
+    """
+    return _stream_page(amount, DEFAULT_ORDERING, True, None, None, 0, db_alias=DEFAULT_CONNECTION_NAME)["streams"]
+
+
+def user_default_img():
+    return url_for('static', filename="user_default.png",
+                   _external=True, _scheme=current_app.config.get("EXTERNAL_SCHEME", "http"))
+
+
+def stream_entry(stream, default_img):
+    """A stream of a page as the clients get it."""
+    streamer = stream["streamer"][0]
+    return {
+        "name": stream["name"], "listeners_length": stream["listeners_count"],
+        "utcdate": stream["date"],
+        "streamer": {
+            "name": streamer.get("display_name", streamer["username"]),
+            "img": streamer.get("img", default_img)
+        },
+        "pk": str(stream["_id"])
+    }
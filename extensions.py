@@ -1,20 +1,95 @@
+import redis
 from authlib.integrations.flask_client import OAuth
 from flask import Flask
 from flask_caching import Cache
 from flask_cors import CORS
 from flask_login import LoginManager, current_user
-from mongoengine import connect
+from mongoengine import connect, DEFAULT_CONNECTION_NAME
+from pymongo import read_preferences
+
+from utils import PoolStats, pool_stats
 
 login_manager = LoginManager()
 oauth = OAuth()
 cache = Cache()
 cors = CORS()
 
+
+class _ObservedRedis(redis.Redis):
+    """Tells the listeners about every command, and every pipeline as one."""
+
+    def __init__(self, *args, command_listeners=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.command_listeners = command_listeners
+
+    def execute_command(self, *args, **options):
+        for listener in self.command_listeners:
+            listener(args[0])
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, *args, **kwargs):
+        for listener in self.command_listeners:
+            listener("PIPELINE")
+        return super().pipeline(*args, **kwargs)
+
+
+class RedisStore(object):
+    """Raw redis client on the cache host, for data that shouldn't go through the pickling cache."""
+
+    def __init__(self):
+        self.client = None
+        self.prefix = ""
+        self.command_listeners = []
+
+    def init_app(self, app: Flask):
+        self.client = _ObservedRedis(host=app.config["CACHE_REDIS_HOST"], command_listeners=self.command_listeners)
+        self.prefix = app.config.get("CACHE_KEY_PREFIX", "")
+
+    def key(self, *parts):
+        return self.prefix + "::".join(str(part) for part in parts)
+
+    def __getattr__(self, item):
+        return getattr(self.client, item)
+
+
+redis_store = RedisStore()
+
 login_manager.login_view = "api.login"
 
 
+# the alias of the directory reads, stream lists and listener lists, see MONGO_WORKLOADS.
+DIRECTORY_DB = "directory"
+
+READ_PREFERENCES = {
+    "primary": read_preferences.Primary,
+    "primaryPreferred": read_preferences.PrimaryPreferred,
+    "secondary": read_preferences.Secondary,
+    "secondaryPreferred": read_preferences.SecondaryPreferred,
+    "nearest": read_preferences.Nearest,
+}
+
+
+def _read_preference(options):
+    mode = options.pop("read_preference", "primary")
+    max_staleness = options.pop("max_staleness_seconds", -1)
+    if mode == "primary":
+        return read_preferences.Primary()
+    return READ_PREFERENCES[mode](max_staleness=max_staleness)
+
+
 def init_db(app: Flask):
-    connect(**app.config.get_namespace("MONGODB_"))
+    """
+    Connects every MONGO_WORKLOADS alias, with the MONGODB_* settings and its own pool and read preference.
+
+    Aliases without an entry get the default workload's options.
+    """
+    workloads = app.config.get("MONGO_WORKLOADS", {})
+    default = workloads.get(DEFAULT_CONNECTION_NAME, {})
+    for alias in dict.fromkeys([DEFAULT_CONNECTION_NAME, DIRECTORY_DB, *workloads]):
+        options = {**app.config.get_namespace("MONGODB_"), **workloads.get(alias, default)}
+        pool_stats[alias] = PoolStats()
+        connect(alias=alias, read_preference=_read_preference(options), event_listeners=[pool_stats[alias]],
+                **options)
 
 
 def fetch_token():
@@ -25,10 +100,9 @@ def fetch_token():
 
 
 def update_token(token, **_):
-    current_user.token.access_token = token["access_token"]
-    current_user.token.refresh_token = token["refresh_token"]
-    current_user.token.expires_at = token["expires_at"]
-    current_user.save()
+    from tokens import token_manager
+    token_manager.store(current_user.id, token)
+    token_manager.persist(current_user.id, token)
 
 
 scope_list = [
@@ -0,0 +1,312 @@
+import json
+import logging
+import uuid
+
+from flask import json as flask_json
+
+import directory
+from extensions import cache, redis_store
+from models import Stream
+from wire import wire
+
+MISSING = object()
+DIRECTORY_ROOM = "directory"
+
+# keeps a directory diff, its worker's seq and the stream count together, so a snapshot reads them as of
+# the same diff. KEYS are the state hash and the diff list, ARGV the worker's seq field, its seq, the
+# stream count delta, the diff and how many diffs are kept. the count is only there once a snapshot set it.
+PUSH_DIFF = """
+redis.call("RPUSH", KEYS[2], ARGV[4])
+redis.call("LTRIM", KEYS[2], -tonumber(ARGV[5]), -1)
+if redis.call("HEXISTS", KEYS[1], "count") == 1 then
+    redis.call("HINCRBY", KEYS[1], "count", ARGV[3])
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+"""
+
+
+def merge_patch(old, new):
+    """
+    JSON merge patch (RFC 7386) that turns ``old`` into ``new``, None when there is nothing to change.
+
+    Removed keys are sent as null, so a null value in the state is the same as a missing one for the client.
+    """
+    patch = {}
+    for key, value in new.items():
+        old_value = old.get(key, MISSING)
+        if isinstance(value, dict) and isinstance(old_value, dict):
+            sub_patch = merge_patch(old_value, value)
+            if sub_patch is not None:
+                patch[key] = sub_patch
+        elif old_value is MISSING or old_value != value:
+            patch[key] = value
+    for key in old.keys() - new.keys():
+        patch[key] = None
+    return patch or None
+
+
+class StreamUpdateCoalescer(object):
+    """
+    Collects ``streamer_update`` states and broadcasts them to the stream rooms once per tick.
+
+    Only the latest state of a tick is sent, as a merge patch against the previous broadcast. Every
+    broadcast has a ``seq``, clients that miss one ask for a ``stream_snapshot``. The last full state
+    is also kept in redis for listeners joining on other workers.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("StreamUpdateCoalescer")
+        self.tick = 0.2
+        self.sio = None
+        # stream name -> (stream session, streamer sid, state)
+        self._pending = {}
+        # stream name -> (seq, state)
+        self._last = {}
+
+    def init_app(self, app, sio):
+        self.tick = float(app.config.get("STREAM_UPDATE_TICK", self.tick))
+        self.sio = sio
+        sio.start_background_task(self._run)
+
+    def submit(self, session, sid, state):
+        self._pending[session.name] = (session, sid, state)
+
+    def snapshot(self, name):
+        if name in self._last:
+            seq, state = self._last[name]
+            return {"stream_data": state, "seq": seq}
+        raw = redis_store.get(redis_store.key("stream_snapshot", name))
+        return json.loads(raw) if raw else None
+
+    def discard(self, name):
+        self._pending.pop(name, None)
+        self._last.pop(name, None)
+        redis_store.delete(redis_store.key("stream_snapshot", name))
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        for name, (session, sid, state) in pending.items():
+            seq, last = self._last.get(name, (0, None))
+            if isinstance(last, dict) and isinstance(state, dict):
+                patch = merge_patch(last, state)
+                if patch is None:
+                    continue
+                data = {"stream_delta": patch, "seq": seq + 1}
+            else:
+                data = {"stream_data": state, "seq": seq + 1}
+
+            self._last[name] = (seq + 1, state)
+            wire.emit_room("listener_update", data=data, room=session.room, shards=session.shards, skip_sid=sid)
+            redis_store.set(redis_store.key("stream_snapshot", name),
+                            json.dumps({"stream_data": state, "seq": seq + 1}))
+
+    def _run(self):
+        while True:
+            self.sio.sleep(self.tick)
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.exception(e)
+
+
+coalescer = StreamUpdateCoalescer()
+
+
+class PresenceDiffs(object):
+    """
+    Collects the joins and leaves of every stream and sends them to its room once per tick.
+
+    A ``presence_diff`` has the summaries of the listeners that joined, the ids of the ones that
+    left and the listener count, so the clients keep their list without asking for it again.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("PresenceDiffs")
+        self.tick = 0.3
+        self.sio = None
+        # stream name -> (stream session, user id -> summary, left user ids)
+        self._pending = {}
+
+    def init_app(self, app, sio):
+        self.tick = float(app.config.get("PRESENCE_DIFF_TICK", self.tick))
+        self.sio = sio
+        sio.start_background_task(self._run)
+
+    def _changes(self, session):
+        if session.name not in self._pending:
+            self._pending[session.name] = (session, {}, set())
+        return self._pending[session.name]
+
+    def joined(self, session, summary):
+        _, added, removed = self._changes(session)
+        removed.discard(summary["pk"])
+        added[summary["pk"]] = summary
+
+    def left(self, session, user_id):
+        _, added, removed = self._changes(session)
+        added.pop(str(user_id), None)
+        removed.add(str(user_id))
+
+    def discard(self, name):
+        self._pending.pop(name, None)
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        for name, (session, added, removed) in pending.items():
+            data = {"added": list(added.values()), "removed": sorted(removed),
+                    "listener_count": session.listener_count}
+            wire.emit_room("presence_diff", data=data, room=session.room, shards=session.shards)
+
+    def _run(self):
+        while True:
+            self.sio.sleep(self.tick)
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.exception(e)
+
+
+presence_diffs = PresenceDiffs()
+
+
+class DirectoryFeed(object):
+    """
+    The live stream directory, for the clients that subscribe instead of polling /api/stream-list.
+
+    A subscriber gets a snapshot of the busiest streams, then ``directory_update`` diffs of the streams
+    that started, stopped and changed listener counts, coalesced per tick. Every worker numbers its
+    own diffs, a diff has the worker's ``host`` and its ``seq`` there, and the snapshot has the last
+    seq of every worker in ``seqs``. A client that gets seq n + 2 from a host after n missed one and
+    subscribes again, a host it hasn't heard of starts at 1.
+
+    The last diffs are kept in redis, the snapshot is cached for a few seconds and sent with the diffs
+    that came after it. The stream count is kept in redis too, next to the seqs, every diff has its
+    ``stream_count_delta``.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("DirectoryFeed")
+        self.host_id = uuid.uuid4().hex[:8]
+        self.tick = 1.0
+        self.size = 50
+        self.snapshot_timeout = 5
+        self.backlog = 100
+        self.sio = None
+        self.script = None
+        self._seq = 0
+        # stream name -> entry
+        self._started = {}
+        self._stopped = set()
+        # stream name -> listener count
+        self._listeners = {}
+        self._count_delta = 0
+
+    def init_app(self, app, sio):
+        self.tick = float(app.config.get("DIRECTORY_FEED_TICK", self.tick))
+        self.size = int(app.config.get("DIRECTORY_FEED_SIZE", app.config.get("MAX_PAGE_SIZE", self.size)))
+        self.snapshot_timeout = int(app.config.get("DIRECTORY_SNAPSHOT_TIMEOUT", self.snapshot_timeout))
+        self.backlog = int(app.config.get("DIRECTORY_BACKLOG", self.backlog))
+        self.script = redis_store.register_script(PUSH_DIFF)
+        self.sio = sio
+        sio.start_background_task(self._run)
+
+    @staticmethod
+    def key(name):
+        return redis_store.key("directory", name)
+
+    def started(self, entry, new=True):
+        """``new`` is False for a stream that was already on, its streamer started it again."""
+        self._stopped.discard(entry["name"])
+        self._listeners.pop(entry["name"], None)
+        self._started[entry["name"]] = entry
+        if new:
+            self._count_delta += 1
+
+    def stopped(self, name):
+        self._started.pop(name, None)
+        self._listeners.pop(name, None)
+        self._stopped.add(name)
+        self._count_delta -= 1
+
+    def listeners(self, name, count):
+        if name in self._started:
+            self._started[name]["listeners_length"] = count
+        else:
+            self._listeners[name] = count
+
+    def subscribe(self):
+        """The snapshot a new subscriber starts from, with the diffs sent since it was taken."""
+        snapshot = cache.get(self.key("snapshot"))
+        diffs = self._diffs_since(snapshot["seqs"]) if snapshot else None
+        if diffs is None:
+            snapshot = self._take_snapshot()
+            cache.set(self.key("snapshot"), snapshot, timeout=self.snapshot_timeout)
+            diffs = self._diffs_since(snapshot["seqs"]) or []
+        return {**snapshot, "diffs": diffs}
+
+    def _state(self):
+        """The stream count and the last seq of every worker, as of the same diff."""
+        state = {key.decode(): int(value) for key, value in redis_store.hgetall(self.key("state")).items()}
+        if "count" not in state:
+            # the first one, the diffs keep it up to date from here on.
+            redis_store.hsetnx(self.key("state"), "count", Stream.objects(active=True).count())
+            return self._state()
+        return state
+
+    def _take_snapshot(self):
+        # the seqs before the query, the diffs after them may be in the snapshot already, their streams
+        # can be applied again. the count is as of the seqs.
+        state = self._state()
+        default_img = directory.user_default_img()
+        return {
+            "seqs": {key[4:]: value for key, value in state.items() if key.startswith("seq:")},
+            "streams": [directory.stream_entry(stream, default_img) for stream in directory.top_streams(self.size)],
+            "stream_count": state["count"],
+        }
+
+    def _diffs_since(self, seqs):
+        """The kept diffs after ``seqs``, None when some of them aren't kept anymore."""
+        newer = []
+        expected = dict(seqs)
+        for raw in redis_store.lrange(self.key("diffs"), 0, -1):
+            diff = flask_json.loads(raw)
+            last = expected.get(diff["host"], 0)
+            if diff["seq"] <= last:
+                continue
+            if diff["seq"] != last + 1:
+                return None
+            expected[diff["host"]] = diff["seq"]
+            newer.append(diff)
+        return newer
+
+    def flush(self):
+        if not (self._started or self._stopped or self._listeners):
+            return
+        started, stopped, listeners, count_delta = self._started, self._stopped, self._listeners, self._count_delta
+        self._started, self._stopped, self._listeners, self._count_delta = {}, set(), {}, 0
+
+        self._seq += 1
+        diff = {"host": self.host_id, "seq": self._seq}
+        if started:
+            diff["started"] = list(started.values())
+        if stopped:
+            diff["stopped"] = sorted(stopped)
+        if listeners:
+            diff["listeners"] = listeners
+        if count_delta:
+            diff["stream_count_delta"] = count_delta
+        # kept before it's sent, a subscriber that joins in between gets it from the backlog.
+        self.script(keys=[self.key("state"), self.key("diffs")],
+                    args=[f"seq:{self.host_id}", self._seq, count_delta, flask_json.dumps(diff), self.backlog])
+        wire.emit_room("directory_update", data=diff, room=DIRECTORY_ROOM)
+
+    def _run(self):
+        while True:
+            self.sio.sleep(self.tick)
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.exception(e)
+
+
+directory_feed = DirectoryFeed()
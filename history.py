@@ -0,0 +1,93 @@
+import json
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pydantic.json import pydantic_encoder
+
+from extensions import redis_store
+from models import ChatAction, ChatMessage, ChatDJ, ChatQueue
+from schemas import MessageSchema, AddDJSchema, AddQueueSchema
+
+
+def _display_name(user):
+    return user.display_name if user.display_name else user.username
+
+
+def to_schema(action: ChatAction):
+    """The chat_action a saved ChatAction was sent as."""
+    date = action.date if action.date.tzinfo else action.date.replace(tzinfo=timezone.utc)
+    if isinstance(action, ChatMessage):
+        return MessageSchema(date=date, sender=_display_name(action.sender), message=action.message)
+    if isinstance(action, ChatDJ):
+        return AddDJSchema(date=date, sender=_display_name(action.sender), who=_display_name(action.who))
+    if isinstance(action, ChatQueue):
+        return AddQueueSchema(date=date, sender=_display_name(action.sender), track=action.track)
+    return None
+
+
+def _parse_date(value):
+    date = datetime.fromisoformat(value)
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+
+class ChatHistory(object):
+    """
+    The last CHAT_HISTORY_SIZE chat actions of every stream, as they were emitted, in a capped redis list.
+
+    Older pages come from Mongo.
+    """
+
+    def __init__(self):
+        self.size = 50
+        self.ttl = 24 * 60 * 60
+
+    def init_app(self, app):
+        self.size = int(app.config.get("CHAT_HISTORY_SIZE", self.size))
+        self.ttl = int(app.config.get("CHAT_HISTORY_TTL", self.ttl))
+
+    @staticmethod
+    def key(stream_id):
+        return redis_store.key("chat_history", stream_id)
+
+    def push(self, stream_id, data):
+        key = self.key(stream_id)
+        pipe = redis_store.pipeline(transaction=False)
+        pipe.lpush(key, json.dumps(data, default=pydantic_encoder))
+        pipe.ltrim(key, 0, self.size - 1)
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def recent(self, stream_id, amount=None):
+        """Newest first."""
+        amount = self.size if amount is None else min(amount, self.size)
+        return [json.loads(raw) for raw in redis_store.lrange(self.key(stream_id), 0, amount - 1)]
+
+    def page(self, stream_id, amount, before=None):
+        """
+        ``amount`` chat actions sent before ``before`` (an isoformat date), newest first.
+
+        Raises ``ValueError`` if ``before`` isn't a date.
+        """
+        before = _parse_date(before) if before else None
+        actions = [action for action in self.recent(stream_id)
+                   if before is None or _parse_date(action["date"]) < before][:amount]
+
+        if len(actions) < amount:
+            # anything newer than what's in redis may not be written yet.
+            if actions:
+                before = _parse_date(actions[-1]["date"])
+            query = ChatAction.objects(stream=ObjectId(stream_id))
+            if before is not None:
+                query = query.filter(date__lt=before)
+            for action in query.order_by("-date").limit(amount - len(actions)).select_related():
+                schema = to_schema(action)
+                if schema is not None:
+                    actions.append(json.loads(json.dumps(schema.dict(exclude_none=True), default=pydantic_encoder)))
+
+        return {
+            "chat": actions,
+            "next_before": actions[-1]["date"] if actions else None
+        }
+
+
+chat_history = ChatHistory()
@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of the chat schemas, pydantic against the fast path.
+
+    python loadtest/bench_schemas.py [--number 100000]
+
+Checks first that both give the same dicts and the same errors.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pydantic import ValidationError  # noqa: E402
+
+from schemas import MessageSchema, AddDJSchema, AddQueueSchema, validate_message, validate_add_dj, \
+    validate_add_queue  # noqa: E402
+
+CASES = [
+    ("text_message", MessageSchema, validate_message, {"message": "hello there, nice track"}),
+    ("dj_add", AddDJSchema, validate_add_dj, {"who": "someone"}),
+    ("queue_add", AddQueueSchema, validate_add_queue, {"track": "4uLU6hMCjMI75M1A2tKUQC"}),
+]
+# coerced or invalid, these go through pydantic
+FALLBACK = [
+    (MessageSchema, validate_message, {"message": "x" * 1000}),
+    (MessageSchema, validate_message, {}),
+    (AddDJSchema, validate_add_dj, {"who": 5}),
+    (AddQueueSchema, validate_add_queue, {"track": None, "date": "yesterday"}),
+]
+
+
+def outcome(func, data):
+    try:
+        result = func(data).dict()
+    except ValidationError as e:
+        return e.errors()
+    result.pop("date")
+    return result
+
+
+def check():
+    for _, model, fast, data in CASES + [(None,) + case for case in FALLBACK]:
+        slow = outcome(lambda d: model(**d, sender="bench"), data)
+        assert slow == outcome(lambda d: fast(d, sender="bench"), data), data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+    check()
+
+    for name, model, fast, data in CASES:
+        slow_s = timeit.timeit(lambda: model(**data, sender="bench").dict(exclude_none=True), number=args.number)
+        fast_s = timeit.timeit(lambda: fast(data, sender="bench").dict(exclude_none=True), number=args.number)
+        print(f"{name:13} pydantic {slow_s / args.number * 1e6:7.2f} us   fast {fast_s / args.number * 1e6:7.2f} us"
+              f"   {slow_s / fast_s:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
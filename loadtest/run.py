@@ -0,0 +1,329 @@
+"""
+Load test, N streamers and M listeners as Socket.IO clients.
+
+    docker compose -f loadtest/docker-compose.yml up -d
+    python loadtest/run.py --spawn-server --streamers 20 --listeners 1000 --duration 60
+
+``--spawn-server`` starts ``app.py`` with FLASK_ENV=loadtest (see LoadTestConfig), otherwise point
+``--url`` at a server running with FLASK_ENV=loadtest, and pass ``--server-pid`` to sample its memory.
+With ``--workers N`` the server is ``workers.py`` and the clients are spread over its N ports,
+starting at the one in ``--url``. How streamer_update throughput scales with the cores shows by
+running the same load, with an update rate one worker can't keep up with, at --workers 1, 2, 4...
+and comparing them with ``--baseline``.
+
+Streamers send ``streamer_update`` and listeners send ``text_message`` and churn (``stop`` then
+``listen_stream`` again) at the given rates. Fan-out latency is measured from the timestamps the
+senders put in the updates and messages to when the listeners get them, so the clients have to run
+on the server's clock. Every run is written to loadtest/results/<run id>.json, next to the server's
+/metrics, read with the METRICS_TOKEN from the environment; ``--baseline`` compares a run to an older one.
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.parse
+import uuid
+
+import eventlet
+
+eventlet.monkey_patch()
+
+import requests  # noqa: E402
+import socketio  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, "loadtest", "results")
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 2)
+
+    return {"count": len(values), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": round(values[-1], 2)}
+
+
+class Stats(object):
+    def __init__(self):
+        # name -> milliseconds
+        self.latencies = collections.defaultdict(list)
+        self.counts = collections.Counter()
+
+    def observe(self, name, ms):
+        self.latencies[name].append(ms)
+
+
+class Client(object):
+    """A logged in Socket.IO client."""
+
+    def __init__(self, url, username, stats):
+        self.stats = stats
+        http = requests.Session()
+        resp = http.post(f"{url}/api/loadtest/login", params={"username": username})
+        resp.raise_for_status()
+        cookie = "; ".join(f"{name}={value}" for name, value in http.cookies.items())
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.connect(url, headers={"Cookie": cookie})
+
+    def call(self, event, data=None, timeout=30):
+        """Emits and waits for the ack."""
+        self.stats.counts[f"sent.{event}"] += 1
+        start = time.perf_counter()
+        try:
+            resp = self.sio.call(event, data, timeout=timeout)
+        except socketio.exceptions.TimeoutError:
+            self.stats.counts[f"timeout.{event}"] += 1
+            return None
+        self.stats.observe(f"ack.{event}", (time.perf_counter() - start) * 1000)
+        return resp
+
+    def emit(self, event, data=None):
+        """Emits without waiting, the ack is still timed."""
+        self.stats.counts[f"sent.{event}"] += 1
+        start = time.perf_counter()
+        self.sio.emit(event, data, callback=lambda *_: self.stats.observe(
+            f"ack.{event}", (time.perf_counter() - start) * 1000))
+
+    def close(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+
+class Listener(Client):
+    def __init__(self, url, username, stats):
+        super().__init__(url, username, stats)
+        self.joined_at = float("inf")
+        self.sio.on("listener_update", self.on_update)
+        self.sio.on("chat_action", self.on_chat)
+
+    def listen(self, stream_name):
+        self.joined_at = time.time()
+        resp = self.call("listen_stream", {"stream_name": stream_name})
+        if not resp or resp["message"]["status"] != "OK":
+            self.stats.counts["failed.listen_stream"] += 1
+
+    def on_update(self, data):
+        self.stats.counts["received.listener_update"] += 1
+        state = data.get("stream_data") or data.get("stream_delta") or {}
+        sent_at = state.get("sent_at")
+        # the snapshot on join carries an update sent before we were there.
+        if sent_at and sent_at >= self.joined_at:
+            self.stats.observe("fanout.streamer_update", (time.time() - sent_at) * 1000)
+
+    def on_chat(self, data):
+        self.stats.counts["received.chat_action"] += 1
+        text = data.get("message") or ""
+        if text.startswith("lt:"):
+            self.stats.observe("fanout.text_message", (time.time() - float(text[3:])) * 1000)
+
+
+def sleep_until(deadline):
+    eventlet.sleep(max(0.0, deadline - time.time()))
+
+
+def run_streamer(client, stream_name, args, started, end_at):
+    resp = client.call("start_stream", {"stream_name": stream_name})
+    if not resp or resp["message"]["status"] != "OK":
+        client.stats.counts["failed.start_stream"] += 1
+    started.send()
+    position = 0
+    while time.time() < end_at:
+        eventlet.sleep(random.expovariate(args.update_rate))
+        position += 1
+        client.emit("streamer_update", {"stream_data": {"sent_at": time.time(), "position": position,
+                                                        "paused": False}})
+    sleep_until(end_at + args.drain)
+    client.call("stop")
+
+
+def run_listener(client, stream_name, args, end_at):
+    client.listen(stream_name)
+    rate = args.message_rate + args.churn_rate
+    while rate > 0:
+        eventlet.sleep(random.expovariate(rate))
+        if time.time() >= end_at:
+            break
+        if random.random() < args.message_rate / rate:
+            client.emit("text_message", {"message": f"lt:{time.time()}"})
+        else:
+            client.call("stop")
+            client.listen(stream_name)
+    sleep_until(end_at + args.drain)
+    client.call("stop")
+
+
+def read_rss(pid):
+    """Resident memory of the process and its children in MB, None where /proc isn't there."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) / 1024 for line in f if line.startswith("VmRSS:"))
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = f.read().split()
+    except (OSError, StopIteration):
+        return None
+    return rss + sum(read_rss(child) or 0 for child in children)
+
+
+def sample_memory(pid, samples, interval=1.0):
+    while True:
+        rss = read_rss(pid)
+        if rss is not None:
+            samples.append(round(rss, 1))
+        eventlet.sleep(interval)
+
+
+def worker_urls(url, workers):
+    if not workers:
+        return [url]
+    parsed = urllib.parse.urlsplit(url)
+    return [parsed._replace(netloc=f"{parsed.hostname}:{parsed.port + i}").geturl() for i in range(workers)]
+
+
+def spawn_server(urls, workers):
+    env = {**os.environ, "FLASK_ENV": "loadtest", "APP_PORT": str(urllib.parse.urlsplit(urls[0]).port)}
+    command = [sys.executable, "workers.py", "--workers", str(workers)] if workers else [sys.executable, "app.py"]
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    pending = list(urls)
+    while pending and time.time() < deadline:
+        try:
+            requests.get(f"{pending[0]}/api/logged-in", timeout=1)
+            pending.pop(0)
+        except requests.ConnectionError:
+            eventlet.sleep(0.5)
+    if not pending:
+        return server
+    server.terminate()
+    raise SystemExit("the server didn't come up in 30 seconds.")
+
+
+def connect_all(factory, names, concurrency):
+    pool = eventlet.GreenPool(concurrency)
+    clients = []
+    for client in pool.imap(factory, names):
+        clients.append(client)
+    return clients
+
+
+def compare(result, baseline):
+    print(f"\ncompared to {baseline['run_id']}:")
+    for name, current in sorted(result["latency_ms"].items()):
+        before = baseline["latency_ms"].get(name)
+        if not before or "p50" not in before or "p50" not in current:
+            continue
+        print(f"  {name:32} p50 {before['p50']:>9} -> {current['p50']:<9} p99 {before['p99']:>9} -> {current['p99']}")
+    for name, current in sorted(result["throughput_per_s"].items()):
+        before = baseline["throughput_per_s"].get(name)
+        if before:
+            print(f"  {name:32} {before:>9}/s -> {current}/s")
+    if baseline.get("server_memory_mb") and result.get("server_memory_mb"):
+        print(f"  {'server peak rss':32} {baseline['server_memory_mb']['peak']:>9} MB -> "
+              f"{result['server_memory_mb']['peak']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--spawn-server", action="store_true")
+    parser.add_argument("--server-pid", type=int)
+    parser.add_argument("--workers", type=int, default=0, help="workers.py workers on consecutive ports")
+    parser.add_argument("--streamers", type=int, default=10)
+    parser.add_argument("--listeners", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of traffic after everyone joined")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for the last updates")
+    parser.add_argument("--update-rate", type=float, default=2, help="streamer_update per streamer per second")
+    parser.add_argument("--message-rate", type=float, default=0.05, help="text_message per listener per second")
+    parser.add_argument("--churn-rate", type=float, default=0.01,
+                        help="stop and listen_stream again, per listener per second")
+    parser.add_argument("--connect-concurrency", type=int, default=50)
+    parser.add_argument("--run-id", default=uuid.uuid4().hex[:6])
+    parser.add_argument("--baseline", help="results of an earlier run to compare to")
+    args = parser.parse_args()
+
+    urls = worker_urls(args.url, args.workers)
+    server = spawn_server(urls, args.workers) if args.spawn_server else None
+    server_pid = server.pid if server else args.server_pid
+    stats = Stats()
+    memory = []
+    if server_pid:
+        eventlet.spawn(sample_memory, server_pid, memory)
+
+    try:
+        # every client stays on one worker, round robin.
+        streamers = connect_all(lambda i: Client(urls[i % len(urls)], f"lt_{args.run_id}_s{i}", stats),
+                                range(args.streamers), args.connect_concurrency)
+        listeners = connect_all(lambda i: Listener(urls[i % len(urls)], f"lt_{args.run_id}_l{i}", stats),
+                                range(args.listeners), args.connect_concurrency)
+        print(f"connected {len(streamers)} streamers and {len(listeners)} listeners.")
+        stream_names = [f"lt-{args.run_id}-{i}" for i in range(args.streamers)]
+
+        started_at = time.time()
+        end_at = started_at + args.duration
+        pool = eventlet.GreenPool(len(streamers) + len(listeners))
+        started = [eventlet.Event() for _ in streamers]
+        for client, name, event in zip(streamers, stream_names, started):
+            pool.spawn(run_streamer, client, name, args, event, end_at)
+        for event in started:
+            event.wait()
+        for i, client in enumerate(listeners):
+            pool.spawn(run_listener, client, stream_names[i % len(stream_names)], args, end_at)
+        pool.waitall()
+        elapsed = time.time() - started_at
+
+        try:
+            token = os.getenv("METRICS_TOKEN")
+            resp = requests.get(f"{args.url}/metrics", timeout=10,
+                                headers={"Authorization": f"Bearer {token}"} if token else {})
+            resp.raise_for_status()
+            server_metrics = resp.text
+        except requests.RequestException:
+            server_metrics = None
+        for client in streamers + listeners:
+            client.close()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    result = {
+        "run_id": args.run_id,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "args": {k: v for k, v in vars(args).items() if k not in ("baseline", "run_id")},
+        "elapsed_s": round(elapsed, 2),
+        "latency_ms": {name: percentiles(values) for name, values in sorted(stats.latencies.items())},
+        "throughput_per_s": {name: round(count / elapsed, 2) for name, count in sorted(stats.counts.items())},
+        "counts": dict(sorted(stats.counts.items())),
+        "server_memory_mb": {"peak": max(memory), "last": memory[-1], "samples": memory} if memory else None,
+    }
+    os.makedirs(RESULTS, exist_ok=True)
+    path = os.path.join(RESULTS, f"{args.run_id}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    if server_metrics:
+        with open(os.path.join(RESULTS, f"{args.run_id}.metrics.txt"), "w") as f:
+            f.write(server_metrics)
+
+    for name, values in result["latency_ms"].items():
+        print(f"  {name:32} {values}")
+    for name, value in result["throughput_per_s"].items():
+        print(f"  {name:32} {value}/s")
+    if result["server_memory_mb"]:
+        print(f"  {'server rss':32} peak {result['server_memory_mb']['peak']} MB")
+    print(f"written to {path}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+import search
+from directory import decode_cursor, encode_cursor, keyset_match
+from extensions import DIRECTORY_DB
+from models import Membership, Stream, User
+
+ORDERINGS = {
+    "joined": (("joined_at", 1), ("_id", 1)),
+}
+
+
+def listener_summary(user_id, display_name, img, default_img):
+    """A listener as the clients get it."""
+    return {"name": display_name or str(user_id), "img": img or default_img, "pk": str(user_id)}
+
+
+def join(stream_id, user: User, sid):
+    """Add ``user`` to the listeners, returns False if it was already listening and only the sid changed."""
+    result = Membership.objects(stream=stream_id, user=user.pk).update_one(
+        upsert=True,
+        full_result=True,
+        set__sid=sid,
+        set_on_insert__joined_at=datetime.utcnow(),
+        set_on_insert__display_name=user.display_name,
+        set_on_insert__img=user.img,
+        set_on_insert__search_name=user.search_name,
+        set_on_insert__search_grams=user.search_grams,
+    )
+    if result.upserted_id is None:
+        return False
+    Stream.objects(pk=stream_id).update_one(inc__listeners_count=1)
+    return True
+
+
+def leave(stream_id, user_id):
+    if Membership.objects(stream=stream_id, user=user_id).delete():
+        Stream.objects(pk=stream_id).update_one(dec__listeners_count=1)
+        return True
+    return False
+
+
+def end(stream_id):
+    """Drop every listener of the stream at once."""
+    Membership.objects(stream=stream_id).delete()
+    Stream.objects(pk=stream_id).update_one(set__listeners_count=0)
+
+
+def listeners(stream_id):
+    """``{user id: sid}`` of the listeners."""
+    return {str(m["user"]): m.get("sid")
+            for m in Membership.objects(stream=stream_id).only("user", "sid").as_pymongo()}
+
+
+def update_user(user: User):
+    """Refresh the copies of the user's profile."""
+    Membership.objects(user=user.pk).update(
+        set__display_name=user.display_name,
+        set__img=user.img,
+        set__search_name=user.search_name,
+        set__search_grams=user.search_grams,
+    )
+
+
+def listener_page(stream_id, amount, filter_=None, cursor=None, from_=0):
+    match = {"stream": ObjectId(stream_id), **search.match(filter_)}
+    count = Membership.objects(__raw__=match).using(DIRECTORY_DB).count()
+
+    if cursor:
+        order_by, values, from_ = decode_cursor(cursor, orderings=ORDERINGS)
+        query = {"$and": [match, keyset_match(order_by, values, orderings=ORDERINGS)]}
+    else:
+        order_by = "joined"
+        query = match
+
+    members = Membership.objects(__raw__=query).using(DIRECTORY_DB).order_by(*[
+        ("+" if direction > 0 else "-") + ("id" if field == "_id" else field)
+        for field, direction in ORDERINGS[order_by]
+    ])
+    if not cursor and from_:
+        members = members.skip(from_)
+    members = list(members.limit(amount).only("user", "display_name", "img", "joined_at").as_pymongo())
+
+    next_cursor = None
+    if members and len(members) == amount:
+        next_cursor = encode_cursor(order_by, members[-1], from_ + len(members), orderings=ORDERINGS)
+    return {"listeners": members, "listener_count": count, "from": from_, "next_cursor": next_cursor}
+
+
+def migrate_listeners():
+    """Move listeners saved in the old ``Stream.listeners`` arrays to Membership."""
+    streams = Stream._get_collection()
+    users = User._get_collection()
+    memberships = Membership._get_collection()
+    # the old stop() left the arrays of ended streams behind, those listeners are gone.
+    streams.update_many({"listeners": {"$exists": True}, "active": {"$ne": True}},
+                        {"$unset": {"listeners": ""}, "$set": {"listeners_count": 0}})
+    for stream in streams.find({"listeners": {"$exists": True}, "active": True}, {"listeners": 1}):
+        docs = [
+            {"stream": stream["_id"], "user": user["_id"], "joined_at": datetime.utcnow(),
+             "display_name": user.get("display_name"),
+             "img": user.get("img"), "search_name": user.get("search_name"),
+             "search_grams": user.get("search_grams", [])}
+            for user in users.find({"_id": {"$in": stream["listeners"]}})
+        ]
+        if docs:
+            try:
+                memberships.insert_many(docs, ordered=False)
+            except BulkWriteError:
+                # some of them were already moved.
+                pass
+        streams.update_one({"_id": stream["_id"]}, {"$unset": {"listeners": ""}, "$set": {
+            "listeners_count": memberships.count_documents({"stream": stream["_id"]})
+        }})
@@ -0,0 +1,255 @@
+import collections
+import functools
+import json
+import logging
+import time
+import uuid
+
+from flask import g, has_request_context, request
+
+from extensions import DIRECTORY_DB, redis_store
+from models import Stream
+from ratelimit import rate_limiter
+from utils import Histogram, command_stats, pool_stats
+from writebehind import chat_writer
+
+PREFIX = "listenparty_"
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, **extra):
+    labels = {**dict(labels), **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"'.replace("\n", " ") for k, v in sorted(labels.items())) + "}"
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else str(bound)
+
+
+class Metrics(object):
+    """
+    Counters, latency histograms and gauges of a worker.
+
+    Every worker pushes its snapshot to redis every METRICS_PUSH_INTERVAL seconds, ``render`` adds up the
+    snapshots of all the workers in the prometheus text format. Gauges are read when the snapshot is taken,
+    ``sum`` gauges are added up across workers, ``max`` ones are the same on every worker.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("Metrics")
+        self.host_id = uuid.uuid4().hex
+        self.sio = None
+        self.interval = 10
+        self.counters = collections.defaultdict(float)
+        self.histograms = collections.defaultdict(Histogram)
+        # name -> (aggregation, function returning [(labels, value)])
+        self.gauges = {}
+        # name -> function returning [(labels, value)], for counters kept elsewhere
+        self.counter_sources = {}
+
+    def init_app(self, app, sio):
+        self.sio = sio
+        self.interval = float(app.config.get("METRICS_PUSH_INTERVAL", self.interval))
+        redis_store.command_listeners.append(lambda command: self.count_call("redis"))
+        command_stats.command_listeners.append(lambda command: self.count_call("mongo"))
+        self.gauge("connected_sids", lambda: [({}, len(sio.server.eio.sockets))])
+        self.gauge("active_streams", lambda: [({}, Stream.objects(active=True).using(DIRECTORY_DB).count())],
+                   aggregation="max")
+        # one series for all the streams, a label per stream name would grow without bound.
+        self.gauge("stream_listeners",
+                   lambda: [({}, Stream.objects(active=True).using(DIRECTORY_DB).sum("listeners_count"))],
+                   aggregation="max")
+        self.gauge("chat_write_pending", lambda: [({}, chat_writer.pending)])
+        self.counter("chat_writes_total", lambda: [({"result": result}, chat_writer.stats[result])
+                                                   for result in ("queued", "written", "failed")])
+        self.counter("chat_write_backpressure_flushes_total",
+                     lambda: [({}, chat_writer.stats["backpressure_flushes"])])
+        self.counter("socket_events_throttled_total", lambda: [({"event": event, "scope": scope}, value)
+                                                               for (event, scope), value in
+                                                               rate_limiter.throttled.items()])
+        self.counter("mongo_command_errors_total", lambda: [({"command": command}, value)
+                                                            for command, value in command_stats.failures.items()])
+        self.gauge("mongo_pool_connections", lambda: [({"workload": alias, "state": state}, sum(counter.values()))
+                                                      for alias, stats in pool_stats.items()
+                                                      for state, counter in (("open", stats.open),
+                                                                             ("in_use", stats.in_use))])
+        self.gauge("mongo_pool_waiting", lambda: [({"workload": alias}, stats.waiting)
+                                                  for alias, stats in pool_stats.items()])
+        # the busiest worker's share of its pool.
+        self.gauge("mongo_pool_utilization", lambda: [({"workload": alias}, stats.utilization)
+                                                      for alias, stats in pool_stats.items()],
+                   aggregation="max")
+        self.counter("mongo_pool_checkout_failures_total", lambda: [({"workload": alias, "reason": reason}, value)
+                                                                    for alias, stats in pool_stats.items()
+                                                                    for reason, value in stats.failures.items()])
+        sio.start_background_task(self._run)
+
+    # recording
+
+    def inc(self, name, value=1, **labels):
+        self.counters[(name, _labels_key(labels))] += value
+
+    def observe(self, name, value, **labels):
+        self.histograms[(name, _labels_key(labels))].observe(value)
+
+    def gauge(self, name, func, aggregation="sum"):
+        self.gauges[name] = (aggregation, func)
+
+    def counter(self, name, func):
+        self.counter_sources[name] = func
+
+    def count_call(self, backend):
+        """Count a call to a backend for the socket event or request being handled."""
+        if has_request_context() and g.get("metrics_calls") is not None:
+            g.metrics_calls[backend] += 1
+
+    def track(self, kind, name):
+        """Decorator recording the count, errors, latency and backend calls of a handler."""
+
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapped(*args, **kwargs):
+                # handlers calling other handlers count their calls too.
+                outer = g.get("metrics_calls")
+                g.metrics_calls = calls = collections.Counter()
+                start = time.perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                except Exception:
+                    self.inc(f"{kind}_errors_total", **{kind: name})
+                    raise
+                finally:
+                    self.inc(f"{kind}s_total", **{kind: name})
+                    self.observe(f"{kind}_duration_ms", (time.perf_counter() - start) * 1000, **{kind: name})
+                    for backend, count in calls.items():
+                        self.inc(f"{kind}_backend_calls_total", count, backend=backend, **{kind: name})
+                    if outer is not None:
+                        outer.update(calls)
+                    g.metrics_calls = outer
+
+            return wrapped
+
+        return decorator
+
+    def instrument_blueprint(self, blueprint):
+        """Records the requests of the blueprint like ``track`` does the socket events."""
+
+        @blueprint.before_request
+        def start_request():
+            g.metrics_calls = collections.Counter()
+            g.metrics_start = time.perf_counter()
+
+        @blueprint.after_request
+        def record_status(response):
+            g.metrics_status = response.status_code
+            return response
+
+        @blueprint.teardown_request
+        def end_request(exc):
+            if "metrics_start" not in g:
+                return
+            endpoint = request.endpoint or "unknown"
+            status = 500 if exc is not None else g.get("metrics_status", 500)
+            self.inc("http_requests_total", endpoint=endpoint, status=status)
+            if status >= 500:
+                self.inc("http_request_errors_total", endpoint=endpoint)
+            self.observe("http_request_duration_ms", (time.perf_counter() - g.metrics_start) * 1000, endpoint=endpoint)
+            for backend, count in g.metrics_calls.items():
+                self.inc("http_request_backend_calls_total", count, backend=backend, endpoint=endpoint)
+
+    # exporting
+
+    def snapshot(self):
+        counters = [[name, list(labels), value] for (name, labels), value in self.counters.items()]
+        for name, func in self.counter_sources.items():
+            counters += [[name, list(labels.items()), value] for labels, value in self._read(func)]
+        gauges = []
+        for name, (aggregation, func) in self.gauges.items():
+            gauges += [[name, aggregation, list(labels.items()), value] for labels, value in self._read(func)]
+        mongo_histograms = {("mongo_command_duration_ms", (("command", command),)): histogram
+                            for command, histogram in command_stats.histograms.items()}
+        mongo_histograms.update({("mongo_pool_wait_ms", (("workload", alias),)): stats.wait
+                                 for alias, stats in pool_stats.items()})
+        return {
+            "counters": counters,
+            "histograms": [[name, list(labels), histogram.counts, histogram.sum, histogram.count]
+                           for (name, labels), histogram in {**self.histograms, **mongo_histograms}.items()],
+            "gauges": gauges,
+        }
+
+    def _read(self, func):
+        try:
+            return list(func())
+        except Exception as e:
+            self.logger.exception(e)
+            return []
+
+    def push(self):
+        redis_store.set(redis_store.key("metrics", self.host_id), json.dumps(self.snapshot()),
+                        ex=int(self.interval * 3))
+
+    def shutdown(self):
+        """Takes this worker out of /metrics, its gauges would be counted until the snapshot expires."""
+        redis_store.delete(redis_store.key("metrics", self.host_id))
+
+    def _run(self):
+        while True:
+            self.sio.sleep(self.interval)
+            try:
+                self.push()
+            except Exception as e:
+                self.logger.exception(e)
+
+    def render(self):
+        self.push()
+        keys = list(redis_store.scan_iter(match=redis_store.key("metrics", "*")))
+        snapshots = [json.loads(raw) for raw in redis_store.mget(keys) if raw] if keys else []
+
+        counters = collections.defaultdict(float)
+        histograms = {}
+        gauges = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                counters[(name, tuple(map(tuple, labels)))] += value
+            for name, labels, counts, sum_, count in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.setdefault(key, [[0] * len(counts), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += sum_
+                merged[2] += count
+            for name, aggregation, labels, value in snapshot["gauges"]:
+                key = (name, tuple(map(tuple, labels)))
+                if aggregation == "max":
+                    gauges[key] = max(gauges.get(key, value), value)
+                else:
+                    gauges[key] = gauges.get(key, 0) + value
+
+        lines = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                lines += [f"{PREFIX}{name}{_format_labels(labels)} {value}"
+                          for (name_, labels), value in values.items() if name_ == name]
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            for (name_, labels), (counts, sum_, count) in histograms.items():
+                if name_ != name:
+                    continue
+                lines += [f"{PREFIX}{name}_bucket{_format_labels(labels, le=_format_bound(bound))} {bucket}"
+                          for bound, bucket in zip(Histogram.buckets, counts)]
+                lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {sum_}")
+                lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def instrumented(event):
+    """Records a socket event handler, goes under ``@sio.on``."""
+    return metrics.track("socket_event", event)
@@ -4,7 +4,7 @@ from mongoengine import EmbeddedDocument, Document
 from mongoengine.fields import EnumField, ReferenceField, StringField, ListField, EmbeddedDocumentField, BooleanField, \
     LazyReferenceField, IntField, URLField, DateTimeField
 
-from extensions import login_manager
+import search
 from utils import utcnow, ACTIVITY
 
 
@@ -32,9 +32,15 @@ class User(Document):
 
     token = EmbeddedDocumentField("Token")
 
+    search_name = StringField()
+    search_grams = ListField(StringField())
+
     def __repr__(self):
         return f"<User::{self.username}>"
 
+    def clean(self):
+        self.search_name, self.search_grams = search.search_fields(self.display_name, self.username)
+
     def get_id(self):
         return self.pk.__str__()
 
@@ -51,10 +57,7 @@ class User(Document):
         return False
 
     meta = {'indexes': [
-        {'fields': ['$username', "$display_name"],
-         'default_language': 'english',
-         'weights': {'username': 5, 'display_name': 5}
-         }
+        {'fields': ['search_grams']},
     ]}
 
 
@@ -62,7 +65,10 @@ class Stream(Document):
     streamer = ReferenceField('User')
     active = BooleanField(default=True)
 
-    listeners = ListField(ReferenceField("User"), default=[])
+    # listeners are kept in Membership, this only counts them.
+    listeners_count = IntField(default=0)
+    # the most shards the stream's room has been split into, see StreamRegistry.join
+    room_shards = IntField(default=1)
 
     name = StringField()
 
@@ -70,11 +76,39 @@ class Stream(Document):
 
     dj = ListField(ReferenceField("User"), default=[])
 
+    search_name = StringField()
+    search_grams = ListField(StringField())
+
+    def clean(self):
+        self.search_name, self.search_grams = search.search_fields(self.name)
+
+    meta = {
+        'strict': False,
+        'indexes': [
+            {'fields': ['active', 'search_grams']},
+            {'fields': ['active', '-listeners_count', '-date', '-id']},
+            {'fields': ['active', '-date', '-id']},
+        ]
+    }
+
+
+class Membership(Document):
+    stream = ReferenceField("Stream", required=True)
+    user = ReferenceField("User", required=True)
+    sid = StringField()
+    joined_at = DateTimeField(default=datetime.utcnow)
+
+    # copied from the user, so the listener list doesn't need to look up users.
+    display_name = StringField()
+    img = URLField()
+    search_name = StringField()
+    search_grams = ListField(StringField())
+
     meta = {'indexes': [
-        {'fields': ['$name'],
-         'default_language': 'english',
-         'weights': {'name': 5}
-         }
+        {'fields': ['stream', 'user'], 'unique': True},
+        {'fields': ['stream', 'joined_at', 'id']},
+        {'fields': ['stream', 'search_grams']},
+        {'fields': ['user']},
     ]}
 
 
@@ -83,7 +117,12 @@ class ChatAction(Document):
     stream = LazyReferenceField("Stream")
     date = DateTimeField(default=utcnow)
 
-    meta = {'allow_inheritance': True}
+    meta = {
+        'allow_inheritance': True,
+        'indexes': [
+            {'fields': ['stream', '-date']},
+        ]
+    }
 
 
 class ChatMessage(ChatAction):
@@ -102,8 +141,3 @@ class Log(Document):
     username = StringField()
     user = LazyReferenceField("User")
     log = StringField()
-
-
-@login_manager.user_loader
-def load_user(user_id):
-    return User.objects.get(pk=user_id)
@@ -0,0 +1,103 @@
+import logging
+
+from extensions import redis_store
+
+# maps the user to the new sid, cancels a pending disconnect and returns the sid it replaced.
+CONNECT = """
+local prev = redis.call("getset", KEYS[1], ARGV[1])
+redis.call("del", KEYS[2])
+return prev
+"""
+
+# forgets the sid only if it's still the user's, and marks the disconnect as pending.
+DISCONNECT = """
+if redis.call("get", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call("del", KEYS[1])
+redis.call("set", KEYS[2], ARGV[1], "ex", ARGV[2])
+return 1
+"""
+
+# the disconnect is final if nobody reconnected and no later disconnect took its place.
+EXPIRE = """
+if redis.call("exists", KEYS[1]) == 1 or redis.call("get", KEYS[2]) ~= ARGV[1] then
+    return 0
+end
+redis.call("del", KEYS[2])
+return 1
+"""
+
+
+class Presence(object):
+    """
+    Which sid every connected user has, in raw redis.
+
+    A disconnect is only final after PRESENCE_GRACE_PERIOD seconds, a reconnect before that keeps
+    whatever the user was doing.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("Presence")
+        self.sio = None
+        self.grace_period = 5.0
+        self.sweep_interval = 60.0
+        self._connect = None
+        self._disconnect = None
+        self._expire = None
+
+    def init_app(self, app, sio):
+        self.sio = sio
+        self.grace_period = float(app.config.get("PRESENCE_GRACE_PERIOD", self.grace_period))
+        self.sweep_interval = float(app.config.get("PRESENCE_SWEEP_INTERVAL", self.sweep_interval))
+        self._connect = redis_store.register_script(CONNECT)
+        self._disconnect = redis_store.register_script(DISCONNECT)
+        self._expire = redis_store.register_script(EXPIRE)
+
+    @staticmethod
+    def key(user_id):
+        return redis_store.key("presence", user_id)
+
+    @staticmethod
+    def pending_key(user_id):
+        return redis_store.key("presence_pending", user_id)
+
+    def sid(self, user_id):
+        sid = redis_store.get(self.key(user_id))
+        return sid.decode() if sid else None
+
+    def absent(self, user_ids):
+        """The users with neither a connection nor a pending disconnect."""
+        pipe = redis_store.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.exists(self.key(user_id), self.pending_key(user_id))
+        return [user_id for user_id, found in zip(user_ids, pipe.execute()) if not found]
+
+    def connect(self, user_id, sid):
+        """Returns the sid of the user's previous connection, if it's still there."""
+        prev = self._connect(keys=[self.key(user_id), self.pending_key(user_id)], args=[sid])
+        prev = prev.decode() if prev else None
+        return prev if prev != sid else None
+
+    def disconnect(self, user_id, sid, on_expire):
+        """Calls ``on_expire`` after the grace period, unless the user came back."""
+        expires_in = max(int(self.grace_period * 2), 1)
+        if not self._disconnect(keys=[self.key(user_id), self.pending_key(user_id)], args=[sid, expires_in]):
+            # another connection took over.
+            return
+        if self.grace_period <= 0:
+            self._expire(keys=[self.key(user_id), self.pending_key(user_id)], args=[sid])
+            on_expire()
+        else:
+            self.sio.start_background_task(self._wait, user_id, sid, on_expire)
+
+    def _wait(self, user_id, sid, on_expire):
+        self.sio.sleep(self.grace_period)
+        try:
+            if self._expire(keys=[self.key(user_id), self.pending_key(user_id)], args=[sid]):
+                on_expire()
+        except Exception as e:
+            self.logger.exception(e)
+
+
+presence = Presence()
@@ -0,0 +1,105 @@
+import collections
+import functools
+import logging
+import time
+
+from flask import request
+from flask_login import current_user
+
+from config import parse_bool
+from extensions import redis_store
+from schemas import ErrorSchema
+from wire import wire
+
+# takes a token from every bucket, or from none of them when one is empty.
+# KEYS are the buckets, ARGV the time and then the rate and the burst of every bucket.
+# returns 0 when the tokens were taken, otherwise the position of the first empty bucket.
+TOKEN_BUCKET = """
+local now = tonumber(ARGV[1])
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call("HMGET", key, "tokens", "at")
+    local level = tonumber(bucket[1]) or burst
+    local at = tonumber(bucket[2]) or now
+    level = math.min(burst, level + math.max(0, now - at) * rate)
+    if level < 1 then
+        return i
+    end
+    levels[i] = level
+end
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+    redis.call("HMSET", key, "tokens", levels[i] - 1, "at", now)
+    redis.call("PEXPIRE", key, math.ceil(burst / rate * 1000))
+end
+return 0
+"""
+
+
+class RateLimiter(object):
+    """
+    Token buckets in redis for the socket events, per user and per stream.
+
+    RATE_LIMITS maps an event to its ``{"user": (rate, burst), "stream": (rate, burst)}``, tokens per
+    second and bucket size. Events and scopes that aren't there aren't limited. When redis can't be
+    reached the events go through.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("RateLimiter")
+        self.enabled = True
+        self.limits = {}
+        self.script = None
+        # (event, scope) -> events dropped
+        self.throttled = collections.Counter()
+
+    def init_app(self, app):
+        self.enabled = parse_bool(app.config.get("RATE_LIMIT_ENABLED", self.enabled))
+        self.limits = app.config.get("RATE_LIMITS", self.limits)
+        self.script = redis_store.register_script(TOKEN_BUCKET)
+
+    def check(self, event, user_id, stream_name=None):
+        """Takes a token for the event, returns the scope that is over its limit or None."""
+        limits = self.limits.get(event)
+        if not self.enabled or not limits:
+            return None
+        scopes = {"user": user_id, "stream": stream_name}
+        buckets = [(scope, rate, burst) for scope, (rate, burst) in limits.items() if scopes.get(scope) is not None]
+        if not buckets:
+            return None
+        keys = [redis_store.key("rate_limit", event, scope, scopes[scope]) for scope, _, _ in buckets]
+        args = [time.time()]
+        for _, rate, burst in buckets:
+            args += [rate, burst]
+        try:
+            empty = self.script(keys=keys, args=args)
+        except Exception as e:
+            self.logger.exception(e)
+            return None
+        if not empty:
+            return None
+        scope = buckets[empty - 1][0]
+        self.throttled[(event, scope)] += 1
+        return scope
+
+    def limit(self, event):
+        """Drops the event when the user or its stream is over the limit, goes under ``@authenticated_only``."""
+
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapped(*args, **kwargs):
+                scope = self.check(event, current_user.id, current_user.stream_name)
+                if scope is not None:
+                    message = "You are sending too fast." if scope == "user" else "This stream is too busy right now."
+                    schema = ErrorSchema(message=message)
+                    wire.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
+                    return
+                return f(*args, **kwargs)
+
+            return wrapped
+
+        return decorator
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,254 @@
+import contextlib
+import json
+import logging
+import uuid
+import zlib
+from typing import Dict, Optional
+
+from bson import DBRef, ObjectId
+
+import memberships
+from extensions import redis_store
+from models import Stream
+
+
+def stream_room_key(name):
+    return f"music__{name}"
+
+
+class StreamSession(object):
+    """Process-local view of an active stream, enough for the socket handlers to work without Mongo."""
+    __slots__ = ("stream_id", "name", "room", "streamer_id", "streamer_sid", "djs", "listeners", "shards")
+
+    def __init__(self, stream_id, name, streamer_id, streamer_sid=None, djs=None, listeners=None, shards=1):
+        self.stream_id = str(stream_id)
+        self.name = name
+        self.room = stream_room_key(name)
+        self.streamer_id = str(streamer_id)
+        self.streamer_sid = streamer_sid
+        self.djs = set(djs or ())
+        # user id -> sid
+        self.listeners: Dict[str, Optional[str]] = dict(listeners or {})
+        # the room is split in this many shard rooms, it only ever grows while the stream is on
+        self.shards = shards
+
+    @property
+    def listener_count(self):
+        return len(self.listeners)
+
+    def to_dbref(self):
+        return DBRef(Stream._get_collection_name(), ObjectId(self.stream_id))
+
+    def can_manage(self, user_id):
+        user_id = str(user_id)
+        return user_id == self.streamer_id or user_id in self.djs
+
+    def to_dict(self):
+        return {
+            "stream_id": self.stream_id,
+            "name": self.name,
+            "streamer_id": self.streamer_id,
+            "streamer_sid": self.streamer_sid,
+            "djs": list(self.djs),
+            "listeners": self.listeners,
+            "shards": self.shards,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+    @classmethod
+    def from_document(cls, stream: Stream, streamer_sid=None):
+        # to_mongo keeps the references as ids instead of dereferencing every user.
+        raw = stream.to_mongo()
+        return cls(
+            stream_id=stream.pk,
+            name=stream.name,
+            streamer_id=raw["streamer"],
+            streamer_sid=streamer_sid,
+            djs=[str(dj) for dj in raw.get("dj", [])],
+            listeners=memberships.listeners(stream.pk),
+            shards=stream.room_shards or 1,
+        )
+
+
+class StreamRegistry(object):
+    """
+    Registry of the active streams, kept in every worker.
+
+    Changes are applied locally and published on a redis channel next to the socketio message queue,
+    so the other workers can apply the same change. Streams this worker hasn't seen yet are loaded
+    from Mongo on first access, the changes that come in while one is loaded are replayed on it.
+    """
+
+    def __init__(self):
+        self.host_id = uuid.uuid4().hex
+        self.channel = "stream_registry"
+        self.logger = logging.getLogger("StreamRegistry")
+        self._streams: Dict[str, StreamSession] = {}
+        self._users: Dict[str, str] = {}
+        # loads from Mongo in progress, and the ops for streams that aren't loaded that came in meanwhile
+        self._loading = 0
+        self._missed = []
+        self.shard_size = 1000
+        self.max_shards = 64
+
+    def init_app(self, app, sio):
+        self.channel = redis_store.key("stream_registry")
+        self.shard_size = int(app.config.get("ROOM_SHARD_SIZE", self.shard_size))
+        self.max_shards = int(app.config.get("ROOM_MAX_SHARDS", self.max_shards))
+        sio.start_background_task(self._listen, sio)
+
+    # reads
+
+    def get(self, name) -> Optional[StreamSession]:
+        session = self._streams.get(name)
+        if session is None:
+            with self._hydrating():
+                stream = Stream.objects(name=name, active=True).first()
+                if stream is not None:
+                    session = self._hydrate(stream)
+        return session
+
+    def sessions(self):
+        """The streams loaded on this worker."""
+        return list(self._streams.values())
+
+    def for_user(self, user) -> Optional[StreamSession]:
+        name = self._users.get(str(user.id))
+        if name is not None and name in self._streams:
+            return self._streams[name]
+        if user.stream_id is None:
+            return None
+        with self._hydrating():
+            stream = Stream.objects(pk=user.stream_id, active=True).first()
+            if stream is None:
+                return None
+            return self._hydrate(stream)
+
+    # writes
+
+    def start(self, stream: Stream, streamer_sid):
+        session = StreamSession.from_document(stream, streamer_sid=streamer_sid)
+        self._publish("start", session.to_dict())
+        return session
+
+    def stop(self, name):
+        self._publish("stop", {"name": name})
+
+    def shard_count(self, listener_count):
+        """Shard rooms for that many listeners, the power of two that keeps them under ROOM_SHARD_SIZE."""
+        shards = 1
+        while shards * self.shard_size < listener_count and shards < self.max_shards:
+            shards *= 2
+        return min(shards, self.max_shards)
+
+    def join(self, name, user_id, sid):
+        """Adds the listener, returns the shard of the stream's room it goes in."""
+        user_id = str(user_id)
+        session = self._streams.get(name)
+        shards = self.shard_count(session.listener_count + 1) if session is not None else 1
+        if session is not None and shards > session.shards:
+            # for the workers that load the stream from mongo later.
+            Stream.objects(pk=session.stream_id).update_one(max__room_shards=shards)
+        self._publish("join", {"name": name, "user_id": user_id, "sid": sid, "shards": shards})
+        return zlib.crc32(user_id.encode()) % shards
+
+    def leave(self, name, user_id):
+        self._publish("leave", {"name": name, "user_id": str(user_id)})
+
+    def add_dj(self, name, user_id):
+        self._publish("add_dj", {"name": name, "user_id": str(user_id)})
+
+    # internals
+
+    @contextlib.contextmanager
+    def _hydrating(self):
+        """Keeps the ops for streams that aren't loaded while a stream is read from Mongo."""
+        self._loading += 1
+        try:
+            yield
+        finally:
+            self._loading -= 1
+            if not self._loading:
+                self._missed.clear()
+
+    def _hydrate(self, stream: Stream):
+        session = StreamSession.from_document(stream)
+        if session.name in self._streams:
+            # started or loaded by someone else while it was read.
+            return self._streams[session.name]
+        self._add_session(session)
+        # Mongo may or may not have these yet, applying them again changes nothing.
+        for op, payload in list(self._missed):
+            if payload.get("name") == session.name:
+                self._apply(op, payload)
+        return self._streams.get(session.name)
+
+    def _add_session(self, session: StreamSession):
+        self._streams[session.name] = session
+        self._users[session.streamer_id] = session.name
+        for user_id in session.listeners:
+            self._users[user_id] = session.name
+
+    def _remove_user(self, user_id, name):
+        if self._users.get(user_id) == name:
+            del self._users[user_id]
+
+    def _apply(self, op, payload):
+        name = payload.get("name")
+        if op == "start":
+            previous = self._streams.get(name)
+            if previous is not None:
+                self._remove_user(previous.streamer_id, name)
+            self._add_session(StreamSession.from_dict(payload))
+            return
+
+        session = self._streams.get(name)
+        if session is None:
+            # never loaded here, it will be hydrated from Mongo when it's needed.
+            if self._loading:
+                self._missed.append((op, payload))
+            return
+
+        if op == "stop":
+            del self._streams[name]
+            self._remove_user(session.streamer_id, name)
+            for user_id in session.listeners:
+                self._remove_user(user_id, name)
+        elif op == "join":
+            session.listeners[payload["user_id"]] = payload["sid"]
+            session.shards = max(session.shards, payload.get("shards", 1))
+            self._users[payload["user_id"]] = name
+        elif op == "leave":
+            session.listeners.pop(payload["user_id"], None)
+            self._remove_user(payload["user_id"], name)
+        elif op == "add_dj":
+            session.djs.add(payload["user_id"])
+
+    def _publish(self, op, payload):
+        self._apply(op, payload)
+        try:
+            redis_store.publish(self.channel, json.dumps({"host_id": self.host_id, "op": op, "payload": payload}))
+        except Exception as e:
+            self.logger.exception(e)
+
+    def _listen(self, sio):
+        while True:
+            try:
+                pubsub = redis_store.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # whatever was published while we weren't subscribed is lost, start over from Mongo.
+                self._streams.clear()
+                self._users.clear()
+                for msg in pubsub.listen():
+                    data = json.loads(msg["data"])
+                    if data["host_id"] != self.host_id:
+                        self._apply(data["op"], data["payload"])
+            except Exception as e:
+                self.logger.exception(e)
+                sio.sleep(1)
+
+
+registry = StreamRegistry()
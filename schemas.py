@@ -1,8 +1,9 @@
+import copy
 import typing
 from datetime import datetime
 from enum import Enum, auto
 
-from pydantic import BaseModel, constr, Field
+from pydantic import BaseModel, ConstrainedStr, constr, Field
 
 from models import ChatMessage
 from utils import utcnow
@@ -34,8 +35,18 @@ class AddDJSchema(ChatActionSchema):
     action_type = ActionType.add_dj
 
 
+class TrackSchema(BaseModel):
+    id: str
+    title: str = None
+    artists: typing.List[str] = []
+    album: str = None
+    img: str = None
+    duration_ms: int = None
+
+
 class AddQueueSchema(ChatActionSchema):
     track: str
+    track_info: TrackSchema = None
     action_type = ActionType.add_queue
 
 
@@ -44,3 +55,81 @@ class ErrorSchema(ChatActionSchema):
     errors: typing.List[typing.Dict[str, typing.Any]] = None
     message: str = None
     sender: str = None
+
+
+class SchemaResult(object):
+    """A validated payload, with the same attributes and ``dict`` as the model."""
+    __slots__ = ()
+
+    def dict(self, exclude_none=False):
+        d = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is None and exclude_none:
+                continue
+            if isinstance(value, BaseModel):
+                value = value.dict(exclude_none=exclude_none)
+            d[name] = value
+        return d
+
+
+class FastSchema(object):
+    """
+    Validates a payload like ``model(**data, **extra)`` in one pass, into a slotted result.
+
+    Only string fields the client sends and defaults it doesn't are handled here. Anything else,
+    pydantic's coercions and every invalid payload go through the model itself, so the results and
+    the ValidationErrors are exactly pydantic's.
+    """
+
+    def __init__(self, model: typing.Type[BaseModel]):
+        self.model = model
+        self.result = type(f"{model.__name__}Result", (SchemaResult,), {"__slots__": tuple(model.__fields__)})
+        # (name, default factory or None for strings, min length, max length)
+        self.fields = []
+        for name, field in model.__fields__.items():
+            if field.required:
+                self.fields.append((name, None) + self._str_bounds(field))
+            else:
+                self.fields.append((name, self._default_factory(field), 0, 0))
+
+    @staticmethod
+    def _str_bounds(field):
+        if field.outer_type_ is str:
+            return 0, float("inf")
+        if issubclass(field.outer_type_, ConstrainedStr) and not (
+                field.outer_type_.strip_whitespace or field.outer_type_.to_lower or field.outer_type_.regex
+                or field.outer_type_.curtail_length):
+            return field.outer_type_.min_length or 0, field.outer_type_.max_length or float("inf")
+        raise TypeError(f"{field.name} can't be validated fast.")
+
+    @staticmethod
+    def _default_factory(field):
+        if field.default_factory is not None:
+            return field.default_factory
+        default = field.default
+        if default is None or isinstance(default, (Enum, str, int, float, bool)):
+            return lambda: default
+        return lambda: copy.deepcopy(default)
+
+    def __call__(self, data, **extra):
+        if type(data) is not dict or not extra.keys().isdisjoint(data):
+            return self.model(**data, **extra)
+
+        result = self.result()
+        for name, default_factory, min_length, max_length in self.fields:
+            if default_factory is None:
+                value = extra[name] if name in extra else data.get(name)
+                if type(value) is not str or not min_length <= len(value) <= max_length:
+                    return self.model(**data, **extra)
+            elif name in data or name in extra:
+                return self.model(**data, **extra)
+            else:
+                value = default_factory()
+            setattr(result, name, value)
+        return result
+
+
+validate_message = FastSchema(MessageSchema)
+validate_add_dj = FastSchema(AddDJSchema)
+validate_add_queue = FastSchema(AddQueueSchema)
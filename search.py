@@ -0,0 +1,67 @@
+import hashlib
+import re
+import unicodedata
+
+from flask import current_app
+
+from extensions import cache
+
+GRAM_SIZE = 3
+# separates the texts in a search name, normalize never leaves one in a query.
+SEPARATOR = "\n"
+
+
+def normalize(text):
+    """Lowercase, strip accents and collapse whitespace."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.lower().split())
+
+
+def grams(text, sizes=range(1, GRAM_SIZE + 1)):
+    return {text[i:i + size] for size in sizes for i in range(len(text) - size + 1)}
+
+
+def search_fields(*texts):
+    """``(search_name, search_grams)`` for a document named by ``texts``."""
+    texts = [normalize(text) for text in texts if text]
+    search_grams = set()
+    for text in texts:
+        search_grams |= grams(text)
+    return SEPARATOR.join(texts), sorted(search_grams)
+
+
+def match(filter_):
+    """
+    Raw query for documents whose search name contains ``filter_``.
+
+    Short queries are a single gram lookup. Longer ones need every trigram of the query, which narrows
+    it down on the index, and the regex only checks the order of the remaining few.
+    """
+    query = normalize(filter_)
+    if not query:
+        return {}
+    if len(query) <= GRAM_SIZE:
+        return {"search_grams": query}
+    return {
+        "search_grams": {"$all": sorted(grams(query, sizes=[GRAM_SIZE]))},
+        "search_name": {"$regex": re.escape(query)}
+    }
+
+
+def cached(namespace, args, func):
+    """Keep the result of ``func()`` for SEARCH_CACHE_TIMEOUT seconds, so typing in the search box is cheap."""
+    key = f"search::{namespace}::" + hashlib.sha1(repr(args).encode()).hexdigest()
+    result = cache.get(key)
+    if result is None:
+        result = func()
+        cache.set(key, result, timeout=current_app.config.get("SEARCH_CACHE_TIMEOUT", 3))
+    return result
+
+
+def ensure_search_fields(*documents):
+    """Fill the search fields of documents saved before they existed."""
+    for document in documents:
+        for doc in document.objects(search_grams__exists=False):
+            doc.clean()
+            doc.update(set__search_name=doc.search_name, set__search_grams=doc.search_grams)
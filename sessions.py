@@ -0,0 +1,249 @@
+import collections
+import json
+import logging
+import uuid
+from typing import Optional
+
+from bson import DBRef, ObjectId
+
+import search
+from extensions import login_manager, redis_store
+from models import User, Stream
+from utils import ACTIVITY, status_snapshot
+
+
+class UserSession(object):
+    """
+    What the handlers need of a logged in user, in place of the whole User document.
+
+    Anything else is read from the document, loaded on first use.
+    """
+    __slots__ = ("id", "username", "display_name", "img", "activity", "stream_id", "stream_name", "status",
+                 "_document")
+
+    def __init__(self, id, username, display_name=None, img=None, activity=ACTIVITY.NONE, stream_id=None,
+                 stream_name=None, status=None):
+        self.id = ObjectId(id)
+        self.username = username
+        self.display_name = display_name
+        self.img = img
+        self.activity = activity
+        self.stream_id = stream_id
+        self.stream_name = stream_name
+        # what prepare_status sends, only recomputed when the activity or the stream changes.
+        self.status = status or self.snapshot()
+        self._document = None
+
+    def __repr__(self):
+        return f"<User::{self.username}>"
+
+    def __getattr__(self, item):
+        if item.startswith("_"):
+            raise AttributeError(item)
+        return getattr(self.document, item)
+
+    @property
+    def document(self) -> User:
+        if self._document is None:
+            self._document = User.objects.get(pk=self.id)
+        return self._document
+
+    @property
+    def pk(self):
+        return self.id
+
+    def get_id(self):
+        return str(self.id)
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def is_active(self):
+        return True
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    @property
+    def search_name(self):
+        return search.search_fields(self.display_name, self.username)[0]
+
+    @property
+    def search_grams(self):
+        return search.search_fields(self.display_name, self.username)[1]
+
+    def snapshot(self):
+        return status_snapshot(self.activity, self.display_name or self.username, self.stream_name)
+
+    def to_dbref(self):
+        return DBRef(User._get_collection_name(), self.id)
+
+    def to_dict(self):
+        return {
+            "id": str(self.id),
+            "username": self.username,
+            "display_name": self.display_name,
+            "img": self.img,
+            "activity": self.activity.name,
+            "stream_id": self.stream_id,
+            "stream_name": self.stream_name,
+            "status": self.status,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**{**d, "activity": ACTIVITY[d["activity"]]})
+
+    @classmethod
+    def from_document(cls, user: User):
+        # the raw id, so the stream isn't dereferenced.
+        stream_id = user.to_mongo().get("stream")
+        stream = Stream.objects(pk=stream_id).only("name").first() if stream_id else None
+        return cls(user.id, user.username, user.display_name, user.img, user.activity,
+                   str(stream.pk) if stream else None, stream.name if stream else None)
+
+
+class UserSessionCache(object):
+    """
+    User sessions in a small LRU per worker, in front of redis.
+
+    Whoever changes a user invalidates its session, on every worker.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("UserSessionCache")
+        self.host_id = uuid.uuid4().hex
+        self.sio = None
+        self.channel = "user_sessions"
+        self.local_size = 4096
+        self.timeout = 60 * 60
+        # user id -> session dict
+        self._local = collections.OrderedDict()
+
+    def init_app(self, app, sio):
+        self.sio = sio
+        self.channel = redis_store.key("user_sessions")
+        self.local_size = int(app.config.get("USER_SESSION_CACHE_SIZE", self.local_size))
+        self.timeout = int(app.config.get("USER_SESSION_CACHE_TIMEOUT", self.timeout))
+        sio.start_background_task(self._listen)
+
+    @staticmethod
+    def key(user_id):
+        return redis_store.key("user_session", user_id)
+
+    def get(self, user_id) -> Optional[UserSession]:
+        user_id = str(user_id)
+        data = self._local.get(user_id)
+        if data is not None:
+            self._local.move_to_end(user_id)
+            return UserSession.from_dict(data)
+
+        raw = redis_store.get(self.key(user_id))
+        if raw is not None:
+            data = json.loads(raw)
+        else:
+            if not ObjectId.is_valid(user_id):
+                return None
+            user = User.objects(pk=user_id).exclude("token", "search_name", "search_grams").first()
+            if user is None:
+                return None
+            data = UserSession.from_document(user).to_dict()
+            redis_store.set(self.key(user_id), json.dumps(data), ex=self.timeout)
+        self._set_local(user_id, data)
+        return UserSession.from_dict(data)
+
+    def _set_local(self, user_id, data):
+        self._local[user_id] = data
+        self._local.move_to_end(user_id)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+    def set_state(self, user: UserSession, activity, stream_id=None, stream_name=None):
+        """Saves what the user is doing and on which stream."""
+        if stream_id is None:
+            User.objects(pk=user.id).update_one(set__activity=activity, unset__stream=True)
+        else:
+            User.objects(pk=user.id).update_one(set__activity=activity, set__stream=ObjectId(stream_id))
+        user.activity = activity
+        user.stream_id = str(stream_id) if stream_id else None
+        user.stream_name = stream_name
+        user.status = user.snapshot()
+        # written through, the next request doesn't go to mongo for what was just set.
+        data = user.to_dict()
+        self._set_local(data["id"], data)
+        pipe = redis_store.pipeline(transaction=False)
+        pipe.set(self.key(data["id"]), json.dumps(data), ex=self.timeout)
+        self._publish(pipe, [data["id"]])
+        pipe.execute()
+
+    def invalidate(self, *user_ids):
+        if not user_ids:
+            return
+        user_ids = [str(user_id) for user_id in user_ids]
+        for user_id in user_ids:
+            self._local.pop(user_id, None)
+        pipe = redis_store.pipeline(transaction=False)
+        pipe.delete(*[self.key(user_id) for user_id in user_ids])
+        self._publish(pipe, user_ids)
+        pipe.execute()
+
+    def _publish(self, pipe, user_ids):
+        pipe.publish(self.channel, json.dumps({"host_id": self.host_id, "user_ids": user_ids}))
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = redis_store.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # invalidations may have been missed while disconnected.
+                self._local.clear()
+                for msg in pubsub.listen():
+                    data = json.loads(msg["data"])
+                    if data["host_id"] != self.host_id:
+                        for user_id in data["user_ids"]:
+                            self._local.pop(user_id, None)
+            except Exception as e:
+                self.logger.exception(e)
+                self.sio.sleep(1)
+
+
+user_sessions = UserSessionCache()
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    return user_sessions.get(user_id)
+
+
+class StatusVersions(object):
+    """
+    The status version last sent to every sid on this worker that connected with ``?status=versioned``.
+
+    Acks to those carry only ``{"version": ...}`` while their status stays the same.
+    """
+
+    def __init__(self):
+        # sid -> version, None until the first status is sent
+        self._sent = {}
+
+    def negotiate(self, sid, requested):
+        if requested == "versioned":
+            self._sent[sid] = None
+
+    def forget(self, sid):
+        self._sent.pop(sid, None)
+
+    def ack(self, sid, status, full=False):
+        if sid not in self._sent:
+            return status
+        version = status["version"]
+        if self._sent[sid] == version and not full:
+            return {"version": version}
+        self._sent[sid] = version
+        return status
+
+
+status_versions = StatusVersions()
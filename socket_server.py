@@ -1,30 +1,31 @@
 import functools
 
-from flask import request, current_app
+from flask import request, current_app, url_for
 from flask_login import current_user
 from flask_socketio import SocketIO, disconnect, leave_room, rooms, join_room
 from mongoengine import DoesNotExist, Q
 from pydantic import ValidationError
 
+import directory
+import memberships
 import utils
-from extensions import cache, oauth
+from fanout import DIRECTORY_ROOM, coalescer, directory_feed, presence_diffs
+from history import chat_history
+from presence import presence
+from ratelimit import rate_limiter
+from metrics import instrumented
 from models import Stream, User, ChatQueue, ChatDJ, ChatMessage
-from schemas import AddDJSchema, AddQueueSchema, MessageSchema, ErrorSchema
+from registry import registry, stream_room_key
+from sessions import user_sessions, status_versions
+from schemas import ErrorSchema, TrackSchema, validate_add_dj, validate_add_queue, validate_message
+from tracks import track_cache
+from wire import wire
+from writebehind import chat_writer
 from utils import prepare_status, message, ACTIVITY
 
 sio = SocketIO()
 
 
-def user_key(user=None):
-    if user:
-        return f"user::{user.id}"
-    return f"user::{current_user.id}"
-
-
-def stream_room_key(name):
-    return f"music__{name}"
-
-
 def get_stream(stream_name, check_active=False) -> Stream:
     if check_active:
         return Stream.objects.get(name=stream_name, active=True)
@@ -44,17 +45,69 @@ def authenticated_only(f):
 
 
 @sio.on('connect')
+@instrumented("connect")
 def connect():
-    prev = cache.get(user_key())
+    wire.negotiate(request.sid, request.args.get("format"))
+    status_versions.negotiate(request.sid, request.args.get("status"))
+    prev = presence.connect(current_user.id, request.sid)
     if prev:
+        # the old connection may be on another worker, the message queue takes it there.
         disconnect(prev)
-    cache.set(user_key(), request.sid, timeout=0)
+    if current_user.activity != ACTIVITY.NONE:
+        resume()
 
 
 @sio.on('disconnect')
+@instrumented("disconnect")
 def disconnect_():
-    cache.delete(user_key())
-    return stop()
+    wire.forget(request.sid)
+    status_versions.forget(request.sid)
+    presence.disconnect(current_user.id, request.sid, functools.partial(
+        stop_disconnected, current_app._get_current_object(), current_user.id, request.sid))
+
+
+def resume():
+    """Puts a user that reconnected back in its stream."""
+    session = registry.for_user(current_user)
+    if session is None:
+        return
+    if current_user.activity != ACTIVITY.LISTEN:
+        add_to_room(session.room, request.sid)
+    else:
+        joined = memberships.join(session.stream_id, current_user, request.sid)
+        # the registry gets the new sid either way, the others only hear of listeners that weren't there.
+        add_to_room(session.room, request.sid, registry.join(session.name, current_user.id, request.sid))
+        if joined:
+            announce_listener(session)
+        snapshot = coalescer.snapshot(session.name)
+        if snapshot:
+            wire.emit("listener_update", data=snapshot, to=request.sid)
+
+
+def stop_disconnected(app, user_id, sid):
+    """Stops whatever a user that didn't come back in time was doing."""
+    with app.app_context():
+        user = user_sessions.get(user_id)
+        if user is not None and user.activity != ACTIVITY.NONE:
+            stop_user(user, sid)
+
+
+def sweep_absent(app):
+    """Stops the users that are gone but weren't stopped, their disconnect was lost with the worker that waited."""
+    while True:
+        sio.sleep(presence.sweep_interval)
+        try:
+            with app.app_context():
+                active = [str(user.pk) for user in User.objects(activity__ne=ACTIVITY.NONE).only("id")]
+                for user_id in presence.absent(active):
+                    stop_disconnected(app, user_id, None)
+        except Exception as e:
+            app.logger.exception(e)
+
+
+def ack_status(full=False):
+    """The status for an ack, only its version if the client already has it."""
+    return status_versions.ack(request.sid, prepare_status(), full)
 
 
 @sio.on_error()
@@ -63,45 +116,56 @@ def error_handler(e):
 
 
 @sio.on("stop")
+@instrumented("stop")
 @authenticated_only
 def stop():
-    stream = current_user.stream
-    if current_user.activity == ACTIVITY.LISTEN:
-        current_app.logger.debug(f"User: {current_user} stopped listening.")
-        current_user.stream = None
-        current_user.activity = ACTIVITY.NONE
-        current_user.save()
+    activity = current_user.activity
+    stop_user(current_user, request.sid)
+    if activity == ACTIVITY.LISTEN:
         leave_rooms()
-
-        stream.update(pull__listeners=current_user.pk)
-        sio.emit("listener_left", to=stream_room_key(stream.name))
-
         return {
             "message": message("Listening is stopped", "ERROR"),
-            "status": prepare_status()
+            "status": ack_status()
         }
-    elif current_user.activity == ACTIVITY.STREAM:
-        stream: Stream = current_user.stream
-        current_app.logger.debug(f"User: {current_user} stopped streaming.")
-        sio.emit("stream_stopped", to=stream_room_key(stream.name),
-                 data={"message": message("Streamer stopped.", "ERROR"),
-                       "status": prepare_status()},
-                 skip_sid=request.sid)
-        for listener in stream.listeners:
-            sid = cache.get(user_key(listener))
-            leave_rooms(sid)
-        User.objects(stream=stream).update(set__activity=ACTIVITY.NONE, unset__stream=None)
-        stream.update(set__active=False)
+    elif activity == ACTIVITY.STREAM:
         leave_rooms()
-        current_user.reload()
-
         return {
             "message": message("Stream is stopped", "ERROR"),
-            "status": prepare_status()
+            "status": ack_status()
         }
 
 
+def stop_user(user, sid):
+    """Stops whatever the user was doing on its connection ``sid``, needs only an app context."""
+    session = registry.for_user(user)
+    if user.activity == ACTIVITY.LISTEN:
+        current_app.logger.debug("User: %s stopped listening.", user)
+        user_sessions.set_state(user, ACTIVITY.NONE)
+
+        if session:
+            memberships.leave(session.stream_id, user.pk)
+            registry.leave(session.name, user.id)
+            directory_feed.listeners(session.name, session.listener_count)
+            presence_diffs.left(session, user.id)
+    elif user.activity == ACTIVITY.STREAM:
+        current_app.logger.debug("User: %s stopped streaming.", user)
+        if session:
+            wire.emit_room("stream_stopped", room=session.room, shards=session.shards,
+                           data={"message": message("Streamer stopped.", "ERROR"),
+                                 "status": dict(user.status)},
+                           skip_sid=sid)
+            # nobody can join from here on, the listeners are let go in the background.
+            Stream.objects(pk=session.stream_id).update(set__active=False)
+            registry.stop(session.name)
+            coalescer.discard(session.name)
+            directory_feed.stopped(session.name)
+            presence_diffs.discard(session.name)
+            sio.start_background_task(teardown_stream, current_app._get_current_object(), session)
+        user_sessions.set_state(user, ACTIVITY.NONE)
+
+
 @sio.on("start_stream")
+@instrumented("start_stream")
 @authenticated_only
 def start_stream(data):
     data["stream_name"] = data["stream_name"].strip()
@@ -109,36 +173,37 @@ def start_stream(data):
         return {
             "message": message("Stream name must be between 5-20 characters and "
                                "should have alphabet, digits, underscore, dash or space characters", "ERROR"),
-            "status": prepare_status()
+            "status": ack_status()
         }
     try:
         stream: Stream = get_stream(data["stream_name"], check_active=True)
         if stream and stream.streamer.id != current_user.id:
             return {
                 "message": message("Stream name already has an active streamer.", "ERROR"),
-                "status": prepare_status()
+                "status": ack_status()
             }
     except DoesNotExist:
         stream = Stream()
         stream.streamer = current_user.to_dbref()
         stream.name = data["stream_name"]
 
-    current_user.activity = ACTIVITY.STREAM
-    current_user.stream = stream
-
     add_to_room(stream_room_key(stream.name), request.sid)
 
+    # the streamer starting its stream again, it's on already.
+    already_on = stream.pk is not None
     stream.save()
-    current_user.save()
-    current_app.logger.debug(f"User: {current_user.id} streaming, '{stream.name}'.")
+    user_sessions.set_state(current_user, ACTIVITY.STREAM, stream.pk, stream.name)
+    announce_stream(stream, registry.start(stream, request.sid), new=not already_on)
+    current_app.logger.debug("User: %s streaming, '%s'.", current_user.id, stream.name)
 
     return {
-        "message": message(f"Started streaming at {stream.name} as {stream.streamer.username}.", "OK"),
-        "status": prepare_status()
+        "message": message(f"Started streaming at {stream.name} as {current_user.username}.", "OK"),
+        "status": ack_status()
     }
 
 
 @sio.on("listen_stream")
+@instrumented("listen_stream")
 @authenticated_only
 def listen_stream(data):
     data["stream_name"] = data["stream_name"].strip()
@@ -146,132 +211,166 @@ def listen_stream(data):
         return {
             "message": message("Stream name must be between 5-20 characters and "
                                "should have alphabet, digits, underscore, dash or space characters", "ERROR"),
-            "status": prepare_status()
+            "status": ack_status()
         }
 
     if current_user.activity == ACTIVITY.STREAM:
         return {
             "message": message("You can't start listening before streaming.", "ERROR"),
-            "status": prepare_status()
+            "status": ack_status()
         }
 
     if current_user.activity == ACTIVITY.LISTEN:
         return {
             "message": message("You can't start listening before leaving previous.", "ERROR"),
-            "status": prepare_status()
+            "status": ack_status()
         }
 
-    try:
-        stream: Stream = get_stream(data["stream_name"], check_active=True)
-    except DoesNotExist:
+    session = registry.get(data["stream_name"])
+    if session is None:
         return {
             "message": message("This is not an active stream", "ERROR"),
-            "status": prepare_status()
+            "status": ack_status()
         }
 
-    stream.update(push__listeners=current_user.to_dbref())
-    current_user.activity = ACTIVITY.LISTEN
-    current_user.stream = stream
-    add_to_room(stream_room_key(stream.name), request.sid)
-    current_user.save()
-    current_app.logger.debug(f"User: {current_user} started listening '{stream.name}'.")
+    memberships.join(session.stream_id, current_user, request.sid)
+    add_to_room(session.room, request.sid, registry.join(session.name, current_user.id, request.sid))
+    announce_listener(session)
+    user_sessions.set_state(current_user, ACTIVITY.LISTEN, session.stream_id, session.name)
+    current_app.logger.debug("User: %s started listening '%s'.", current_user, session.name)
+
+    snapshot = coalescer.snapshot(session.name)
+    if snapshot:
+        wire.emit("listener_update", data=snapshot, to=request.sid)
+    wire.emit("chat_history", data={"chat": chat_history.recent(session.stream_id)}, to=request.sid)
 
     return {
-        "message": message(f"Started listening at {stream.name} as {current_user.username}.", "OK"),
-        "status": prepare_status()
+        "message": message(f"Started listening at {session.name} as {current_user.username}.", "OK"),
+        "status": ack_status()
     }
 
 
 @sio.on("streamer_update")
+@instrumented("streamer_update")
 @authenticated_only
+@rate_limiter.limit("streamer_update")
 def streamer_update(data):
     if current_user.activity == ACTIVITY.STREAM and data.get("stream_data", None):
-        current_app.logger.debug(
-            f"Stream update for '{current_user.stream.name}', {len(current_user.stream.listeners)} listeners.")
-        sio.emit("listener_update",
-                 data={"stream_data": data["stream_data"]},
-                 to=stream_room_key(current_user.stream.name),
-                 skip_sid=request.sid)
+        session = registry.for_user(current_user)
+        if session is None:
+            return {
+                "status": ack_status()
+            }
+        current_app.logger.debug("Stream update for '%s', %s listeners.", session.name, session.listener_count)
+        coalescer.submit(session, request.sid, data["stream_data"])
         return {
-            "status": prepare_status()
+            "status": ack_status()
         }
 
 
+@sio.on("directory_subscribe")
+@instrumented("directory_subscribe")
+@authenticated_only
+def directory_subscribe():
+    join_room(DIRECTORY_ROOM)
+    return directory_feed.subscribe()
+
+
+@sio.on("directory_unsubscribe")
+@instrumented("directory_unsubscribe")
+@authenticated_only
+def directory_unsubscribe():
+    leave_room(DIRECTORY_ROOM)
+    return {}
+
+
+@sio.on("stream_snapshot")
+@instrumented("stream_snapshot")
+@authenticated_only
+def stream_snapshot():
+    session = registry.for_user(current_user)
+    if session is None:
+        return {}
+    return coalescer.snapshot(session.name) or {}
+
+
 @sio.on("dj_add")
+@instrumented("dj_add")
 @authenticated_only
 def dj_add(data):
     try:
-        schema = AddDJSchema(**data, sender=current_user.display_name)
+        schema = validate_add_dj(data, sender=current_user.display_name)
     except ValidationError as e:
         schema = ErrorSchema(errors=e.errors())
-        sio.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
+        wire.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
         return
 
-    if not (current_user == current_user.stream.streamer or current_user in current_user.stream.dj):
+    session = registry.for_user(current_user)
+    if not (session and session.can_manage(current_user.id)):
         schema = ErrorSchema(message="You dont have the permission for that")
-        sio.emit("chat_action", data=schema.dict(exclude_none=True))
+        wire.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
         return
     try:
         new_dj: User = User.objects(Q(username=schema.who) | Q(display_name=schema.who)).get()
     except DoesNotExist:
         schema = ErrorSchema(message=f"User, '{schema.who}', doesn't exist.")
-        sio.emit("chat_action", data=schema.dict(exclude_none=True))
+        wire.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
         return
 
-    if new_dj not in current_user.stream.dj and new_dj != current_user.stream.streamer:
-        current_user.stream.update(push__dj=new_dj)
+    if not session.can_manage(new_dj.id):
+        Stream.objects(pk=session.stream_id).update(push__dj=new_dj)
+        registry.add_dj(session.name, new_dj.id)
+        send_chat_action(session, schema.dict(exclude_none=True))
+
         model = ChatDJ()
-        model.sender = current_user
-        model.stream = current_user.stream
+        model.sender = current_user.to_dbref()
+        model.stream = session.to_dbref()
         model.date = schema.date
-        model.who = new_dj
-        model.save()
-
-        sio.emit("chat_action", data=schema.dict(exclude_none=True), include_self=True,
-                 to=stream_room_key(current_user.stream.name))
+        model.who = new_dj.to_dbref()
+        chat_writer.put(model)
     else:
         schema = ErrorSchema(message=f"User, '{schema.who}', is already a DJ.")
-        sio.emit("chat_action", data=schema.dict(exclude_none=True))
+        wire.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
         return
 
 
 @sio.on("queue_add")
+@instrumented("queue_add")
 @authenticated_only
+@rate_limiter.limit("queue_add")
 def queue_add(data):
     try:
-        schema = AddQueueSchema(**data, sender=current_user.display_name)
+        schema = validate_add_queue(data, sender=current_user.display_name)
     except ValidationError as e:
         schema = ErrorSchema(errors=e.errors())
-        sio.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
+        wire.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
         return
 
-    if not (current_user == current_user.stream.streamer or current_user in current_user.stream.dj):
+    session = registry.for_user(current_user)
+    if not (session and session.can_manage(current_user.id)):
         schema = ErrorSchema(message="You dont have the permission for that")
-        sio.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
+        wire.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
         return
 
-    resp = oauth.spotify.get(f"tracks/{schema.track}")
-    if resp.status_code != 200:
+    track_info = track_cache.get(schema.track)
+    if track_info is None:
         schema = ErrorSchema(message="Invalid track")
-        sio.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
+        wire.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
         return
+    schema.track_info = TrackSchema(**track_info)
 
     model = ChatQueue()
-    model.sender = current_user
-    model.stream = current_user.stream
+    model.sender = current_user.to_dbref()
+    model.stream = session.to_dbref()
     model.date = schema.date
     model.track = schema.track
-    model.save()
-
-    stream_name = current_user.stream.name
+    chat_writer.put(model)
 
     def callback(data_):
         if data_["status"] == "ok":
-            sio.emit("chat_action",
-                     data=schema.dict(exclude_none=True),
-                     to=stream_room_key(stream_name), include_self=True)
+            send_chat_action(session, schema.dict(exclude_none=True))
 
-    key = cache.get(user_key(current_user.stream.streamer))
+    key = presence.sid(session.streamer_id) or session.streamer_sid
     sio.emit("add_queue", to=key, data={"track": schema.track}, include_self=True,
              callback=callback)
 
@@ -279,40 +378,78 @@ def queue_add(data):
 
 
 @sio.on("text_message")
+@instrumented("text_message")
 @authenticated_only
+@rate_limiter.limit("text_message")
 def text_message(data):
     try:
-        schema = MessageSchema(**data, sender=current_user.display_name)
+        schema = validate_message(data, sender=current_user.display_name)
     except ValidationError as e:
         schema = ErrorSchema(errors=e.errors())
-        sio.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
+        wire.emit("chat_action", data=schema.dict(exclude_none=True), to=request.sid)
+        return
+
+    session = registry.for_user(current_user)
+    if session is None:
         return
 
+    send_chat_action(session, schema.dict())
+
     model = ChatMessage()
-    model.sender = current_user
-    model.stream = current_user.stream
+    model.sender = current_user.to_dbref()
+    model.stream = session.to_dbref()
     model.date = schema.date
     model.message = schema.message
-    model.save()
-
-    sio.emit("chat_action",
-             data={**schema.dict(), "sender": current_user.display_name},
-             to=stream_room_key(current_user.stream.name), include_self=True)
+    chat_writer.put(model)
 
 
 @sio.on("status")
+@instrumented("status")
 def status():
-    return {"status": prepare_status()}
+    return {"status": ack_status(full=True)}
+
+
+def teardown_stream(app, session):
+    """Takes the listeners out of a stopped stream, with a few bulk calls however many they are."""
+    try:
+        wire.close_room(session.room, shards=session.shards)
+        User.objects(stream=session.stream_id).update(set__activity=ACTIVITY.NONE, unset__stream=None)
+        user_sessions.invalidate(*session.listeners)
+        memberships.end(session.stream_id)
+    except Exception as e:
+        app.logger.exception(e)
+
+
+def send_chat_action(session, data):
+    wire.emit_room("chat_action", data=data, room=session.room, shards=session.shards, include_self=True)
+    chat_history.push(session.stream_id, data)
+
+
+def announce_stream(stream, session, new=True):
+    """Tells the directory subscribers about a stream that just started."""
+    streamer = {field: getattr(current_user, field) for field in ("username", "display_name", "img")
+                if getattr(current_user, field)}
+    raw = {"_id": stream.pk, "name": stream.name, "listeners_count": session.listener_count, "date": stream.date,
+           "streamer": [streamer]}
+    directory_feed.started(directory.stream_entry(raw, directory.user_default_img()), new=new)
+
+
+def announce_listener(session):
+    """Tells the stream's room and the directory subscribers about a listener that just joined."""
+    presence_diffs.joined(session, memberships.listener_summary(
+        current_user.id, current_user.display_name, current_user.img, url_for('static', filename="user_default.png")))
+    directory_feed.listeners(session.name, session.listener_count)
 
 
 def leave_rooms(sid=None):
-    # user should be in max 1 room.
+    # user should be in max 1 stream room, and maybe the directory.
+    keep = (sid or request.sid, DIRECTORY_ROOM)
     for room in rooms(sid=sid):
-        if room != sid:
+        if room not in keep:
             leave_room(room)
 
 
-def add_to_room(room_name, sid=None):
+def add_to_room(room_name, sid=None, shard=0):
     leave_rooms(sid=sid)
-    print(room_name)
-    join_room(room=room_name, sid=sid)
+    current_app.logger.debug("Joining %s, shard %s.", room_name, shard)
+    join_room(room=wire.shard_room(room_name, shard), sid=sid)
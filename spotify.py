@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+from urllib.parse import urljoin, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from flask_login import current_user
+
+from metrics import metrics
+
+
+class SpotifyError(Exception):
+    def __init__(self, response=None, status_code=None, message=None):
+        self.response = response
+        self.status_code = response.status_code if response is not None else status_code
+        super().__init__(message or f"Spotify responded with {self.status_code}.")
+
+
+class SpotifyClient(object):
+    """
+    Spotify web api client with one pooled keep-alive session per worker.
+
+    At most SPOTIFY_MAX_CONCURRENCY requests are in flight at once. After a 429 every request waits
+    for the Retry-After the api asked for, or fails right away when that is longer than SPOTIFY_TIMEOUT.
+    Track lookups are batched: the ones requested within
+    SPOTIFY_BATCH_WINDOW seconds share one ``tracks?ids=`` request, made with the app's own token.
+    """
+    api_base_url = 'https://api.spotify.com/v1/'
+    token_url = 'https://accounts.spotify.com/api/token'
+    batch_size = 50
+
+    def __init__(self):
+        self.logger = logging.getLogger("SpotifyClient")
+        self.session = None
+        self.sio = None
+        self.client_id = None
+        self.client_secret = None
+        self.timeout = 10
+        self.max_retries = 2
+        self.batch_window = 0.02
+        # how long a track lookup waits for its batch
+        self.lookup_timeout = self.batch_window + self.timeout
+        self._limiter = None
+        self._blocked_until = 0.0
+        self._app_token = None
+        # track id -> _PendingTrack waiting for the next batch
+        self._pending_tracks = {}
+
+    def init_app(self, app, sio):
+        pool_size = int(app.config.get("SPOTIFY_POOL_SIZE", 20))
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=pool_size))
+        self.sio = sio
+        self.client_id = app.config["SPOTIFY_CLIENT_ID"]
+        self.client_secret = app.config["SPOTIFY_CLIENT_SECRET"]
+        self.timeout = float(app.config.get("SPOTIFY_TIMEOUT", self.timeout))
+        self.max_retries = int(app.config.get("SPOTIFY_MAX_RETRIES", self.max_retries))
+        self.batch_window = float(app.config.get("SPOTIFY_BATCH_WINDOW", self.batch_window))
+        self.lookup_timeout = self.batch_window + self.timeout
+        self._limiter = threading.BoundedSemaphore(int(app.config.get("SPOTIFY_MAX_CONCURRENCY", pool_size)))
+
+    # requests
+
+    def request(self, method, path, token=None, **kwargs):
+        """Request with the current user's token unless another one is given."""
+        if token is None:
+            from tokens import token_manager
+            token = token_manager.get(current_user.id)
+
+        headers = {"Authorization": f"Bearer {token['access_token']}", **kwargs.pop("headers", {})}
+        return self._send(method, urljoin(self.api_base_url, path), headers=headers, **kwargs)
+
+    def get(self, path, token=None, **kwargs):
+        return self.request("GET", path, token=token, **kwargs)
+
+    def _send(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.max_retries + 1):
+            # waited out before taking a slot, so the blocked requests don't hold up the others.
+            wait = self._blocked_until - time.time()
+            if wait > self.timeout:
+                raise SpotifyError(status_code=429, message=f"Rate limited by spotify for {wait:.0f} more seconds.")
+            if wait > 0:
+                self.sio.sleep(wait)
+            with self._limiter:
+                resp = self._observed_request(method, url, **kwargs)
+            if resp.status_code != 429 or attempt == self.max_retries:
+                return resp
+            retry_after = int(resp.headers.get("Retry-After", 1))
+            self.logger.warning("Rate limited by spotify for %s seconds.", retry_after)
+            self._blocked_until = max(self._blocked_until, time.time() + retry_after)
+            if retry_after > self.timeout:
+                return resp
+        return resp
+
+    def _observed_request(self, method, url, **kwargs):
+        path = urlparse(url).path
+        endpoint = path.rsplit("/", 1)[-1] if url == self.token_url else path[len("/v1/"):].split("/", 1)[0]
+        metrics.count_call("spotify")
+        start = time.perf_counter()
+        status = "error"
+        try:
+            resp = self.session.request(method, url, **kwargs)
+            status = resp.status_code
+            return resp
+        finally:
+            metrics.inc("spotify_requests_total", endpoint=endpoint, status=status)
+            metrics.observe("spotify_request_duration_ms", (time.perf_counter() - start) * 1000, endpoint=endpoint)
+
+    # tokens
+
+    def _token_request(self, data):
+        resp = self._send("POST", self.token_url, data=data, auth=(self.client_id, self.client_secret))
+        if resp.status_code != 200:
+            raise SpotifyError(resp)
+        token = resp.json()
+        token["expires_at"] = int(time.time()) + int(token["expires_in"])
+        return token
+
+    def refresh_token(self, token):
+        new_token = self._token_request({"grant_type": "refresh_token", "refresh_token": token["refresh_token"]})
+        # spotify only sends a new refresh token when it rotates it.
+        new_token.setdefault("refresh_token", token["refresh_token"])
+        return new_token
+
+    def app_token(self):
+        """Client credentials token, for the catalog endpoints."""
+        if self._app_token is None or self._app_token["expires_at"] < time.time() + 30:
+            self._app_token = self._token_request({"grant_type": "client_credentials"})
+        return self._app_token
+
+    # tracks
+
+    def track(self, track_id):
+        """
+        The track object, None for tracks spotify doesn't know.
+
+        Raises ``SpotifyError`` when the batch it was in failed or didn't answer within ``lookup_timeout``.
+        """
+        pending = self._pending_tracks.get(track_id)
+        if pending is None:
+            if not self._pending_tracks:
+                self.sio.start_background_task(self._fetch_tracks)
+            pending = self._pending_tracks[track_id] = _PendingTrack(self.sio.server.eio.create_event())
+        if not pending.event.wait(self.lookup_timeout):
+            raise SpotifyError(message=f"Track lookup for {track_id} timed out.")
+        if isinstance(pending.result, Exception):
+            raise pending.result
+        return pending.result
+
+    def _fetch_tracks(self):
+        self.sio.sleep(self.batch_window)
+        while self._pending_tracks:
+            batch = {track_id: self._pending_tracks.pop(track_id)
+                     for track_id in list(self._pending_tracks)[:self.batch_size]}
+            try:
+                resp = self._send("GET", urljoin(self.api_base_url, "tracks"), params={"ids": ",".join(batch)},
+                                  headers={"Authorization": f"Bearer {self.app_token()['access_token']}"})
+                if resp.status_code != 200:
+                    raise SpotifyError(resp)
+                results = dict(zip(batch, resp.json()["tracks"]))
+            except Exception as e:
+                if not isinstance(e, SpotifyError):
+                    self.logger.exception(e)
+                results = {track_id: e for track_id in batch}
+
+            for track_id, pending in batch.items():
+                pending.result = results.get(track_id)
+                pending.event.set()
+
+
+class _PendingTrack(object):
+    __slots__ = ("event", "result")
+
+    def __init__(self, event):
+        self.event = event
+        self.result = None
+
+
+spotify = SpotifyClient()
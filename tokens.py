@@ -0,0 +1,152 @@
+import json
+import logging
+import time
+import uuid
+
+from extensions import redis_store
+from models import User
+from spotify import spotify, SpotifyError
+
+# deletes the lock only if it's still the one we took.
+RELEASE_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class TokenManager(object):
+    """
+    Spotify tokens of the users, cached in redis.
+
+    Tokens that expire within TOKEN_REFRESH_MARGIN seconds are refreshed, by a background task before
+    anyone asks for them, or by whoever asks first. A redis lock makes sure only one worker refreshes a
+    token. Tokens nobody asked for in TOKEN_CACHE_TIMEOUT seconds are dropped from the cache and no
+    longer refreshed.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("TokenManager")
+        self.sio = None
+        self.margin = 5 * 60
+        self.interval = 30
+        self.timeout = 24 * 60 * 60
+        self.lock_timeout = 10
+        self._release_lock = None
+
+    def init_app(self, app, sio):
+        self.sio = sio
+        self.margin = int(app.config.get("TOKEN_REFRESH_MARGIN", self.margin))
+        self.interval = float(app.config.get("TOKEN_REFRESH_INTERVAL", self.interval))
+        self.timeout = int(app.config.get("TOKEN_CACHE_TIMEOUT", self.timeout))
+        self._release_lock = redis_store.register_script(RELEASE_LOCK)
+        sio.start_background_task(self._run)
+
+    @staticmethod
+    def key(user_id):
+        return redis_store.key("token", user_id)
+
+    @staticmethod
+    def expiry_key():
+        return redis_store.key("token_expiry")
+
+    def get(self, user_id):
+        """A token of the user that's valid for at least the refresh margin."""
+        user_id = str(user_id)
+        token = self._cached(user_id, touch=True)
+        if token is None:
+            user = User.objects(pk=user_id).only("token").first()
+            token = user.token.to_token()
+            self.store(user_id, token)
+        if self._expiring(token):
+            token = self.refresh(user_id)
+        return token
+
+    def store(self, user_id, token):
+        pipe = redis_store.pipeline(transaction=False)
+        pipe.set(self.key(user_id), json.dumps(token), ex=self.timeout)
+        pipe.zadd(self.expiry_key(), {str(user_id): token["expires_at"]})
+        pipe.execute()
+
+    def forget(self, user_id):
+        pipe = redis_store.pipeline(transaction=False)
+        pipe.delete(self.key(user_id))
+        pipe.zrem(self.expiry_key(), str(user_id))
+        pipe.execute()
+
+    def persist(self, user_id, token):
+        User.objects(pk=user_id).update_one(
+            set__token__access_token=token["access_token"],
+            set__token__refresh_token=token["refresh_token"],
+            set__token__expires_at=token["expires_at"],
+        )
+
+    def refresh(self, user_id):
+        lock_key = redis_store.key("token_lock", user_id)
+        lock = uuid.uuid4().hex
+        if not redis_store.set(lock_key, lock, nx=True, ex=self.lock_timeout):
+            return self._wait_for_refresh(user_id, lock_key)
+        try:
+            token = self._cached(user_id)
+            if token is None or self._expiring(token):
+                if token is None:
+                    token = User.objects(pk=user_id).only("token").first().token.to_token()
+                token = spotify.refresh_token(token)
+                self.store(user_id, token)
+                self.persist(user_id, token)
+            return token
+        finally:
+            self._release_lock(keys=[lock_key], args=[lock])
+
+    def _wait_for_refresh(self, user_id, lock_key):
+        deadline = time.time() + self.lock_timeout
+        while redis_store.exists(lock_key) and time.time() < deadline:
+            self.sio.sleep(0.1)
+        token = self._cached(user_id)
+        if token is None:
+            token = User.objects(pk=user_id).only("token").first().token.to_token()
+        return token
+
+    def _cached(self, user_id, touch=False):
+        if touch:
+            pipe = redis_store.pipeline(transaction=False)
+            pipe.get(self.key(user_id))
+            pipe.expire(self.key(user_id), self.timeout)
+            raw, _ = pipe.execute()
+        else:
+            raw = redis_store.get(self.key(user_id))
+        return json.loads(raw) if raw else None
+
+    def _expiring(self, token):
+        return token["expires_at"] < time.time() + self.margin
+
+    def _run(self):
+        while True:
+            self.sio.sleep(self.interval)
+            try:
+                self.refresh_expiring()
+            except Exception as e:
+                self.logger.exception(e)
+
+    def refresh_expiring(self):
+        due = redis_store.zrangebyscore(self.expiry_key(), 0, time.time() + self.margin)
+        for user_id in due:
+            user_id = user_id.decode()
+            if not redis_store.exists(self.key(user_id)):
+                # not used for a while.
+                redis_store.zrem(self.expiry_key(), user_id)
+                continue
+            try:
+                self.refresh(user_id)
+            except SpotifyError as e:
+                if e.status_code == 400:
+                    # the refresh token was revoked, the user has to log in again.
+                    self.forget(user_id)
+                else:
+                    self.logger.exception(e)
+            except Exception as e:
+                self.logger.exception(e)
+
+
+token_manager = TokenManager()
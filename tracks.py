@@ -0,0 +1,124 @@
+import collections
+import logging
+import re
+import time
+
+from extensions import cache
+from spotify import spotify, SpotifyError
+
+# spotify ids are base62, anything else would only be a wasted request.
+TRACK_ID_RE = re.compile(r"^[0-9A-Za-z]{22}$")
+# cached for tracks spotify doesn't know.
+INVALID = {}
+
+
+def track_summary(track):
+    """The part of a spotify track object that is sent with chat actions."""
+    album = track.get("album") or {}
+    images = album.get("images") or []
+    return {
+        "id": track["id"],
+        "title": track.get("name"),
+        "artists": [artist.get("name") for artist in track.get("artists", [])],
+        "album": album.get("name"),
+        "img": images[0]["url"] if images else None,
+        "duration_ms": track.get("duration_ms"),
+    }
+
+
+class TrackCache(object):
+    """
+    Spotify track metadata, in a small LRU in front of the redis cache.
+
+    Unknown tracks are cached too, for a shorter time. Concurrent lookups of the same id in a worker
+    wait for the first one instead of calling spotify again.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("TrackCache")
+        self.local_size = 1024
+        self.timeout = 24 * 60 * 60
+        self.negative_timeout = 5 * 60
+        self.sio = None
+        # track id -> (expires at, metadata)
+        self._local = collections.OrderedDict()
+        # track id -> event set when the lookup is done
+        self._in_flight = {}
+
+    def init_app(self, app, sio):
+        self.local_size = int(app.config.get("TRACK_CACHE_LOCAL_SIZE", self.local_size))
+        self.timeout = int(app.config.get("TRACK_CACHE_TIMEOUT", self.timeout))
+        self.negative_timeout = int(app.config.get("TRACK_CACHE_NEGATIVE_TIMEOUT", self.negative_timeout))
+        self.sio = sio
+
+    @staticmethod
+    def key(track_id):
+        return f"track::{track_id}"
+
+    def get(self, track_id):
+        """Metadata of the track, None if it isn't a valid track."""
+        if not TRACK_ID_RE.match(track_id):
+            return None
+
+        metadata = self._get_local(track_id)
+        if metadata is None:
+            metadata = cache.get(self.key(track_id))
+            if metadata is not None:
+                self._set_local(track_id, metadata, self.timeout if metadata else self.negative_timeout)
+        if metadata is None:
+            metadata = self._fetch_once(track_id)
+        return metadata or None
+
+    def _get_local(self, track_id):
+        entry = self._local.get(track_id)
+        if entry is None:
+            return None
+        expires_at, metadata = entry
+        if expires_at < time.monotonic():
+            del self._local[track_id]
+            return None
+        self._local.move_to_end(track_id)
+        return metadata
+
+    def _set_local(self, track_id, metadata, timeout):
+        self._local[track_id] = (time.monotonic() + timeout, metadata)
+        self._local.move_to_end(track_id)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+    def _set(self, track_id, metadata):
+        timeout = self.timeout if metadata else self.negative_timeout
+        cache.set(self.key(track_id), metadata, timeout=timeout)
+        self._set_local(track_id, metadata, timeout)
+
+    def _fetch_once(self, track_id):
+        event = self._in_flight.get(track_id)
+        if event is not None:
+            if not event.wait(spotify.lookup_timeout):
+                return None
+            return self._get_local(track_id)
+
+        event = self._in_flight[track_id] = self.sio.server.eio.create_event()
+        try:
+            metadata = self._fetch(track_id)
+            if metadata is not None:
+                self._set(track_id, metadata)
+            return metadata
+        finally:
+            del self._in_flight[track_id]
+            event.set()
+
+    def _fetch(self, track_id):
+        """None when spotify couldn't answer, so nothing is cached."""
+        try:
+            track = spotify.track(track_id)
+        except SpotifyError as e:
+            self.logger.warning("Track lookup for %s failed: %s", track_id, e)
+            return None
+        except Exception as e:
+            self.logger.exception(e)
+            return None
+        return track_summary(track) if track else INVALID
+
+
+track_cache = TrackCache()
@@ -1,8 +1,15 @@
+import atexit
+import collections
+import importlib
 import logging
+import random
 import re
+import threading
+import time
+import zlib
 from datetime import datetime, timezone
 from enum import Enum
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 from typing import Any
 
 from flask.json import JSONEncoder
@@ -45,47 +52,209 @@ def utcnow():
     return datetime.now(timezone.utc)
 
 
-class CommandLogger(monitoring.CommandListener):
+class Histogram(object):
+    """Cumulative latency histogram, in milliseconds."""
+    buckets = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf"))
+
     def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class CommandStats(monitoring.CommandListener):
+    """
+    Latency histograms of the PyMongo commands, per command name.
+
+    Only MONGO_LOG_SAMPLE_RATE of the commands are logged, and only when the logger is at DEBUG.
+    """
+
+    def __init__(self, sample_rate=0.0):
         self.logger = logging.getLogger("PyMongo")
+        self.sample_rate = sample_rate
+        self.histograms = collections.defaultdict(Histogram)
+        self.failures = collections.Counter()
+        self.command_listeners = []
+
+    def _sampled(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate and self.logger.isEnabledFor(logging.DEBUG)
 
     def started(self, event):
-        self.logger.debug("Command {0.command_name} with request id "
-                          "{0.request_id} started on server "
-                          "{0.connection_id}".format(event))
+        pass
 
     def succeeded(self, event):
-        self.logger.debug("Command {0.command_name} with request id "
-                          "{0.request_id} on server {0.connection_id} "
-                          "succeeded in {0.duration_micros} "
-                          "microseconds".format(event))
+        self.histograms[event.command_name].observe(event.duration_micros / 1000)
+        for listener in self.command_listeners:
+            listener(event.command_name)
+        if self._sampled():
+            self.logger.debug("Command %s with request id %s on server %s succeeded in %s microseconds",
+                              event.command_name, event.request_id, event.connection_id, event.duration_micros)
 
     def failed(self, event):
-        self.logger.debug("Command {0.command_name} with request id "
-                          "{0.request_id} on server {0.connection_id} "
-                          "failed in {0.duration_micros} "
-                          "microseconds".format(event))
+        self.histograms[event.command_name].observe(event.duration_micros / 1000)
+        self.failures[event.command_name] += 1
+        for listener in self.command_listeners:
+            listener(event.command_name)
+        if self._sampled():
+            self.logger.debug("Command %s with request id %s on server %s failed in %s microseconds",
+                              event.command_name, event.request_id, event.connection_id, event.duration_micros)
+
+
+command_stats = CommandStats()
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+    Connections of a MongoClient's pools, the ones in use and how long the check outs waited.
+
+    One per connection alias, given to its client as an event listener.
+    """
+
+    def __init__(self):
+        self.max_pool_size = 100
+        # server address -> connections
+        self.open = collections.Counter()
+        self.in_use = collections.Counter()
+        self.waiting = 0
+        self.wait = Histogram()
+        self.failures = collections.Counter()
+        # thread (greenlet under eventlet) -> when its check out started
+        self._started = {}
+
+    @property
+    def utilization(self):
+        """In use over the pool size, of the busiest server."""
+        return max(self.in_use.values(), default=0) / self.max_pool_size
+
+    def pool_created(self, event):
+        self.max_pool_size = int(event.options.get("maxPoolSize", self.max_pool_size))
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        self.open.pop(event.address, None)
+        self.in_use.pop(event.address, None)
+
+    def connection_created(self, event):
+        self.open[event.address] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.open[event.address] = max(self.open[event.address] - 1, 0)
+
+    def connection_check_out_started(self, event):
+        self.waiting += 1
+        self._started[threading.get_ident()] = time.perf_counter()
+
+    def _check_out_done(self):
+        self.waiting = max(self.waiting - 1, 0)
+        start = self._started.pop(threading.get_ident(), None)
+        if start is not None:
+            self.wait.observe((time.perf_counter() - start) * 1000)
+
+    def connection_check_out_failed(self, event):
+        self._check_out_done()
+        self.failures[event.reason] += 1
+
+    def connection_checked_out(self, event):
+        self._check_out_done()
+        self.in_use[event.address] += 1
+
+    def connection_checked_in(self, event):
+        self.in_use[event.address] = max(self.in_use[event.address] - 1, 0)
+
 
+# connection alias -> PoolStats
+pool_stats = {}
 
-def configure_global_logging():
+
+def _original(module):
+    """The module as it was before eventlet patched it."""
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return importlib.import_module(module)
+    return patcher.original(module)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Only merges the arguments into the message, they may be proxies that mean nothing in another thread.
+
+    Formatting the rest of the record and the traceback is left to the listener.
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class ThreadedQueueListener(QueueListener):
+    """QueueListener that writes from an OS thread even when threading is monkey patched."""
+
+    def start(self):
+        self._thread = _original("threading").Thread(target=self._monitor, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # once, from shutdown_logging or atexit, whichever comes first.
+        if self._thread is not None:
+            super().stop()
+
+
+class ThreadedFileHandler(TimedRotatingFileHandler):
+    """File handler for the listener thread, a green lock can't be taken from an OS thread."""
+
+    def createLock(self):
+        self.lock = _original("threading").RLock()
+
+
+log_listener = None
+
+
+def configure_global_logging(config):
+    global log_listener
     log_format = '%(asctime)s--%(name)s:%(levelname)s:%(message)s'
-    log_file = ".logs/listenParty.log"
+    log_file = getattr(config, "LOG_FILE", ".logs/listenParty.log")
+    log_level = getattr(config, "LOG_LEVEL", "DEBUG")
 
-    file_handler = TimedRotatingFileHandler(filename=log_file, when='midnight', backupCount=2)
-    file_handler.setLevel("DEBUG")
+    file_handler = ThreadedFileHandler(filename=log_file, when='midnight', backupCount=2)
+    file_handler.setLevel(log_level)
     file_handler.setFormatter(logging.Formatter(log_format))
-    logger = logging.getLogger()
-    logger.addHandler(file_handler)
-    logger.setLevel("DEBUG")
 
-    monitoring.register(CommandLogger())
+    # records are formatted and written by the listener thread, logging calls only put them in the queue.
+    log_queue = _original("queue").SimpleQueue()
+    log_listener = ThreadedQueueListener(log_queue, file_handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+    command_stats.sample_rate = float(getattr(config, "MONGO_LOG_SAMPLE_RATE", 0.0))
+    monitoring.register(command_stats)
 
     # log = logging.getLogger('authlib')
     # log.setLevel("DEBUG")
     # log.addHandler(logging.StreamHandler(sys.stdout))
 
     # noinspection PyArgumentList
-    logging.basicConfig(format=log_format, level='DEBUG', handlers=[file_handler])
+    logging.basicConfig(format=log_format, level=log_level, handlers=[DeferredQueueHandler(log_queue)])
+
+
+def shutdown_logging():
+    """Writes out the queued records and closes the log files."""
+    if log_listener is not None:
+        log_listener.stop()
+    logging.shutdown()
 
 
 def message(text, status_):
@@ -94,20 +263,24 @@ def message(text, status_):
     }
 
 
+def status_snapshot(activity, username, stream_name):
+    """The status of a user, versioned by its content so every worker gives the same version."""
+    _status = {
+        "activity": activity.name,
+        "username": username,
+        "stream": stream_name,
+    }
+    _status["version"] = format(zlib.crc32(repr(sorted(_status.items())).encode()), "08x")
+    return _status
+
+
+anonymous_status = status_snapshot(ACTIVITY.NONE, None, None)
+
+
 def prepare_status():
     if isinstance(current_user, AnonymousUserMixin):
-        _status = {
-            "activity": ACTIVITY.NONE.name,
-            "username": None,
-            "stream": None,
-        }
-    else:
-        _status = {
-            "activity": current_user.activity.name,
-            "username": current_user.display_name if current_user.display_name else current_user.username,
-            "stream": current_user.stream.name if current_user.stream else None,
-        }
-    return _status
+        return dict(anonymous_status)
+    return dict(current_user.status)
 
 
 class Validator:
@@ -0,0 +1,194 @@
+import logging
+from datetime import date, datetime
+from enum import Enum
+
+import msgpack
+import redis
+import socketio
+from pydantic.json import pydantic_encoder
+from socketio import packet
+
+from config import parse_bool
+
+queue_logger = logging.getLogger("socketio")
+
+# events a client that connected with ?format=msgpack gets as one msgpack encoded binary argument,
+# everything else is still json.
+PACKED_EVENTS = {"listener_update", "presence_diff", "chat_action", "chat_history"}
+# msgpack has no tuples, emit arguments are sent as this extension type.
+TUPLE = 1
+
+
+def _default(o):
+    # the types the schemas and stream updates actually have come first.
+    if isinstance(o, (datetime, date)):
+        return o.isoformat()
+    if isinstance(o, Enum):
+        return o.value
+    if isinstance(o, tuple):
+        return msgpack.ExtType(TUPLE, pack(list(o)))
+    if isinstance(o, dict):
+        return dict(o)
+    if isinstance(o, list):
+        return list(o)
+    return pydantic_encoder(o)
+
+
+def _ext_hook(code, data):
+    if code == TUPLE:
+        return tuple(unpack(data))
+    return msgpack.ExtType(code, data)
+
+
+def pack(data):
+    return msgpack.packb(data, default=_default, strict_types=True, use_bin_type=True)
+
+
+def unpack(raw):
+    return msgpack.unpackb(raw, ext_hook=_ext_hook, raw=False)
+
+
+class FanoutRedisManager(socketio.RedisManager):
+    """
+    Redis message queue that sends room emits to the local clients in chunks.
+
+    The packet is encoded once for the whole room instead of once per client, and the worker
+    yields to the other greenlets every ROOM_FANOUT_CHUNK clients. An emit can go to a list of
+    rooms, the shards of a stream's room, which are sent one after the other.
+
+    The queue message is the same for every client. The PACKED_EVENTS are msgpack encoded by the
+    worker that sends them out, once, and only when one of its clients in the room asked for it.
+    """
+
+    def __init__(self, *args, chunk_size=500, is_packed=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunk_size = chunk_size
+        self.is_packed = is_packed or (lambda sid: False)
+
+    @staticmethod
+    def _encode(namespace, event, data):
+        if isinstance(data, tuple):
+            data = list(data)
+        elif data is not None:
+            data = [data]
+        else:
+            data = []
+        encoded = packet.Packet(packet.EVENT, namespace=namespace, data=[event] + data).encode()
+        return encoded if isinstance(encoded, list) else [encoded]
+
+    def _handle_emit(self, message):
+        room = message.get("room")
+        namespace = message.get("namespace") or "/"
+        if room is None or message.get("callback") is not None:
+            return super()._handle_emit(message)
+        if namespace not in self.rooms:
+            return
+
+        event = message["event"]
+        encoded = self._encode(namespace, event, message["data"])
+        # encoded on the first client that wants it
+        packed = None if event in PACKED_EVENTS else encoded
+        skip_sid = message.get("skip_sid")
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+
+        sent = 0
+        for room in room if isinstance(room, list) else [room]:
+            # get_participants copies the room, clients may join or leave while we yield.
+            for sid, eio_sid in self.get_participants(namespace, room):
+                if sid in skip_sid:
+                    continue
+                parts = encoded
+                if self.is_packed(sid):
+                    if packed is None:
+                        packed = self._encode(namespace, event, pack(message["data"]))
+                    parts = packed
+                for part in parts:
+                    self.server.eio.send(eio_sid, part)
+                sent += 1
+                if sent % self.chunk_size == 0:
+                    self.server.sleep(0)
+
+
+class MsgPackRedisManager(FanoutRedisManager):
+    """
+    Redis message queue that publishes msgpack instead of pickles.
+
+    Pickles from workers that still use the default manager are read as before.
+    """
+
+    def _publish(self, data):
+        packed = pack(data)
+        retry = True
+        while True:
+            try:
+                if not retry:
+                    self._redis_connect()
+                return self.redis.publish(self.channel, packed)
+            except redis.exceptions.RedisError:
+                if retry:
+                    queue_logger.error('Cannot publish to redis... retrying')
+                    retry = False
+                else:
+                    queue_logger.error('Cannot publish to redis... giving up')
+                    break
+
+    def _listen(self):
+        for message in super()._listen():
+            try:
+                data = unpack(message)
+            except Exception:
+                # a pickle.
+                yield message
+                continue
+            yield data if isinstance(data, dict) else message
+
+
+class Wire(object):
+    """
+    The payload format of every connection on this worker.
+
+    Clients that connect with ``?format=msgpack`` get the PACKED_EVENTS msgpack encoded, so a room
+    emit is encoded once for all of them instead of to json per client. They're in the same rooms as
+    everyone else, FanoutRedisManager picks the encoding of every sid.
+    """
+
+    def __init__(self):
+        self.sio = None
+        self.msgpack = True
+        # sid -> "msgpack", json sids aren't kept
+        self._formats = {}
+
+    def init_app(self, app, sio):
+        self.sio = sio
+        self.msgpack = parse_bool(app.config.get("WIRE_MSGPACK", self.msgpack))
+
+    def negotiate(self, sid, requested):
+        if self.msgpack and requested == "msgpack":
+            self._formats[sid] = "msgpack"
+
+    def forget(self, sid):
+        self._formats.pop(sid, None)
+
+    def is_packed(self, sid):
+        return sid in self._formats
+
+    @staticmethod
+    def shard_room(room, shard):
+        return f"{room}::{shard}" if shard else room
+
+    def emit(self, event, data=None, to=None, **kwargs):
+        """Emit to a sid, in its format."""
+        self.sio.emit(event, data=data, to=to, **kwargs)
+
+    def emit_room(self, event, data=None, room=None, shards=1, **kwargs):
+        """Emit to everyone in the room and its shards, with one message for all the formats."""
+        rooms = [self.shard_room(room, shard) for shard in range(shards)]
+        self.sio.emit(event, data=data, to=rooms if shards > 1 else room, **kwargs)
+
+    def close_room(self, room, shards=1):
+        for shard in range(shards):
+            self.sio.close_room(self.shard_room(room, shard))
+
+
+wire = Wire()
@@ -0,0 +1,136 @@
+"""
+Runs the app in several eventlet workers, one per core by default.
+
+    python workers.py [--workers N]
+    python workers.py --nginx > /etc/nginx/conf.d/listenparty.conf
+
+Worker i listens on APP_PORT + i and logs to its own LOG_FILE. The Engine.IO session ids it hands out
+start with "<i>.", so the proxy in front sends the polling requests of a session to the worker that
+has it, ``--nginx`` prints such a config. Websocket only clients don't need that, any worker will do.
+
+Everything else the workers share is in redis: the Socket.IO message queue, presence, the caches and
+their invalidations. Only worker 0 runs the startup migrations.
+"""
+import argparse
+import os
+import runpy
+import signal
+import sys
+import time
+
+from config import config
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class Worker(object):
+    """Which worker this process is, None when it wasn't started by the launcher."""
+
+    def __init__(self):
+        self.index = None
+
+    def init_app(self, app, sio):
+        index = app.config.get("WORKER_ID")
+        self.index = int(index) if index not in (None, "") else None
+        if self.index is not None:
+            eio = sio.server.eio
+            generate_id = eio.generate_id
+            eio.generate_id = lambda: f"{self.index}.{generate_id()}"
+
+    @property
+    def primary(self):
+        return self.index in (None, 0)
+
+
+worker = Worker()
+
+
+def worker_log_file(index):
+    base, ext = os.path.splitext(config.LOG_FILE)
+    return f"{base}.{index}{ext}"
+
+
+def spawn(index):
+    pid = os.fork()
+    if pid:
+        return pid
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    os.environ["WORKER_ID"] = str(index)
+    os.environ["APP_PORT"] = str(int(config.APP_PORT) + index)
+    os.environ["LOG_FILE"] = worker_log_file(index)
+    sys.argv = [os.path.join(ROOT, "app.py")]
+    # the config is read again, with the worker's environment.
+    sys.modules.pop("config", None)
+    runpy.run_path(sys.argv[0], run_name="__main__")
+    sys.exit(0)
+
+
+def nginx_config(count):
+    host = "127.0.0.1" if config.APP_HOST in ("0.0.0.0", "") else config.APP_HOST
+    servers = [f"{host}:{int(config.APP_PORT) + i}" for i in range(count)]
+    lines = ["upstream listenparty {", "    least_conn;"]
+    lines += [f"    server {server};" for server in servers]
+    lines += ["}", "", "# the worker that gave out the session id, any worker for a new session.",
+              "map $arg_sid $listenparty_worker {", "    default listenparty;"]
+    lines += [f'    "~^{i}\\." {server};' for i, server in enumerate(servers)]
+    lines += ["}", "", "map $http_upgrade $connection_upgrade {", "    default upgrade;", "    '' close;", "}", "",
+              "server {", "    listen 80;", "", "    location / {", "        proxy_pass http://$listenparty_worker;",
+              "        proxy_http_version 1.1;", "        proxy_set_header Upgrade $http_upgrade;",
+              "        proxy_set_header Connection $connection_upgrade;", "        proxy_set_header Host $host;",
+              "        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;",
+              "        proxy_set_header X-Forwarded-Proto $scheme;", "    }", "}"]
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(config.WORKERS) or os.cpu_count())
+    parser.add_argument("--stop-timeout", type=int, default=30,
+                        help="seconds the workers have to exit after SIGTERM before they're killed")
+    parser.add_argument("--nginx", action="store_true", help="print the proxy config for the workers and exit")
+    args = parser.parse_args()
+    if args.nginx:
+        print(nginx_config(args.workers))
+        return
+
+    # pid -> worker index
+    children = {}
+    stopping = False
+
+    def signal_all(signum):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        signal_all(signal.SIGTERM)
+        signal.alarm(args.stop_timeout)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGALRM, lambda *_: signal_all(signal.SIGKILL))
+    for index in range(args.workers):
+        children[spawn(index)] = index
+    print(f"started {args.workers} workers on ports {config.APP_PORT}-{int(config.APP_PORT) + args.workers - 1}.")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        print(f"worker {index} exited with {status}, restarting it.")
+        time.sleep(1)
+        children[spawn(index)] = index
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import atexit
+import collections
+import logging
+import time
+
+from pymongo.errors import BulkWriteError
+
+from models import ChatAction
+
+DUPLICATE_KEY = 11000
+
+
+class ChatWriter(object):
+    """
+    Write-behind queue for chat actions.
+
+    Handlers ``put`` the documents and move on, a background task writes them with ``insert_many``
+    every CHAT_WRITE_INTERVAL seconds or as soon as CHAT_WRITE_BATCH_SIZE of them are waiting. When
+    CHAT_WRITE_MAX_PENDING are waiting, the handler that adds one more flushes them itself.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("ChatWriter")
+        self.batch_size = 100
+        self.interval = 1.0
+        self.max_pending = 10000
+        self.sio = None
+        self._buffer = collections.deque()
+        self._flush_scheduled = False
+        self.stats = {
+            "queued": 0,
+            "written": 0,
+            "failed": 0,
+            "backpressure_flushes": 0,
+            "max_pending": 0,
+            "last_flush_ms": 0.0,
+        }
+
+    def init_app(self, app, sio):
+        self.batch_size = int(app.config.get("CHAT_WRITE_BATCH_SIZE", self.batch_size))
+        self.interval = float(app.config.get("CHAT_WRITE_INTERVAL", self.interval))
+        self.max_pending = int(app.config.get("CHAT_WRITE_MAX_PENDING", self.max_pending))
+        self.sio = sio
+        sio.start_background_task(self._run)
+        atexit.register(self.flush)
+
+    @property
+    def pending(self):
+        return len(self._buffer)
+
+    def put(self, model: ChatAction):
+        model.validate()
+        self._buffer.append(model.to_mongo())
+        self.stats["queued"] += 1
+        self.stats["max_pending"] = max(self.stats["max_pending"], self.pending)
+
+        if self.pending >= self.max_pending:
+            self.stats["backpressure_flushes"] += 1
+            self.flush()
+        elif self.pending >= self.batch_size and not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.sio.start_background_task(self.flush)
+
+    def flush(self):
+        self._flush_scheduled = False
+        while self._buffer:
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            start = time.perf_counter()
+            try:
+                ChatAction._get_collection().insert_many(batch, ordered=False)
+                self.stats["written"] += len(batch)
+            except BulkWriteError as e:
+                # the rest of the batch is written. a duplicate _id was written by an earlier try.
+                failed = [error for error in e.details.get("writeErrors", []) if error.get("code") != DUPLICATE_KEY]
+                self.stats["written"] += len(batch) - len(failed)
+                self.stats["failed"] += len(failed)
+                self.logger.error("Dropped %s of %s chat actions: %s", len(failed), len(batch), failed[:1])
+            except Exception as e:
+                self.logger.exception(e)
+                self._requeue(batch)
+                # tried again on the next tick.
+                break
+            finally:
+                self.stats["last_flush_ms"] = (time.perf_counter() - start) * 1000
+
+    def _requeue(self, batch):
+        """Puts a batch that wasn't written back in front, the oldest go when more than max_pending wait."""
+        self._buffer.extendleft(reversed(batch))
+        while len(self._buffer) > self.max_pending:
+            self._buffer.popleft()
+            self.stats["failed"] += 1
+
+    def _run(self):
+        while True:
+            self.sio.sleep(self.interval)
+            self.flush()
+
+
+chat_writer = ChatWriter()